@@ -4,7 +4,7 @@ API de Administración - facturalo.pro
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
 
-from src.api.dependencies import get_db
+from src.api.dependencies import get_db, invalidar_emisor_cache
 from src.models.models import Emisor
 from src.api.v1.auth import generar_api_credentials
 
@@ -40,6 +40,7 @@ async def activar_api_emisor(
     emisor.docs_mes_usados = 0
     
     db.commit()
+    invalidar_emisor_cache(emisor.ruc, emisor.id)
     
     return {
         "exito": True,
@@ -1,24 +1,84 @@
 from fastapi import Request, HTTPException
 from jose import jwt, JWTError
 from sqlalchemy.orm import Session
+from cachetools import TLRUCache
 from src.models.models import Emisor
+from src.api.dependencies import EmisorSesion, emisor_sesion_por_id
+import hashlib
 import os
+import threading
+import time
 
 SECRET_KEY = os.getenv("SECRET_KEY", "dev-secret-key-cambiar-en-produccion")
 
-async def obtener_emisor_actual(request: Request, db: Session) -> Emisor:
-    token = request.cookies.get("session_token")
-    if not token:
-        raise HTTPException(status_code=401, detail="No autorizado")
-    
+# Payloads ya verificados, por hash del token. Cada entrada vive como máximo 60 s y
+# nunca más allá del `exp` del token. Los tokens inválidos no se cachean.
+_jwt_cache = TLRUCache(
+    maxsize=10000,
+    ttu=lambda _key, payload, now: min(now + 60, payload["exp"]),
+    timer=time.time,
+)
+_jwt_cache_lock = threading.Lock()
+
+
+def _decodificar_token(token: str) -> dict:
+    clave = hashlib.blake2b(token.encode(), digest_size=16).hexdigest()
+    with _jwt_cache_lock:
+        payload = _jwt_cache.get(clave)
+    if payload is not None:
+        return payload
+
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-        emisor_id = payload.get("emisor_id")
+        payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"], options={"require_exp": True})
     except JWTError:
         raise HTTPException(status_code=401, detail="Sesión expirada")
-    
-    emisor = db.query(Emisor).filter(Emisor.id == emisor_id).first()
+    if not payload.get("emisor_id"):
+        raise HTTPException(status_code=401, detail="Sesión expirada")
+
+    with _jwt_cache_lock:
+        _jwt_cache[clave] = payload
+    return payload
+
+
+def payload_sesion(request: Request) -> dict:
+    """Payload del JWT de la cookie session_token, decodificado una sola vez por
+    request (queda en request.state) y entre requests vía _jwt_cache.
+    401 si no hay cookie o el token no es válido."""
+    payload = getattr(request.state, "jwt_payload", None)
+    if payload is not None:
+        return payload
+
+    token = request.cookies.get("session_token")
+    if not token:
+        raise HTTPException(status_code=401, detail="No autorizado")
+
+    payload = _decodificar_token(token)
+    request.state.jwt_payload = payload
+    return payload
+
+
+def obtener_emisor_sesion(request: Request, db: Session, *opciones) -> Emisor:
+    """Versión síncrona: para handlers `def`, que FastAPI corre en el threadpool
+    y así no bloquean el event loop con las consultas a la BD.
+    `opciones`: loader options extra (p. ej. joinedload de relaciones)."""
+    emisor_id = payload_sesion(request)["emisor_id"]
+
+    emisor = db.query(Emisor).options(*opciones).filter(Emisor.id == emisor_id).first()
+    if not emisor:
+        raise HTTPException(status_code=404, detail="Emisor no encontrado")
+
+    return emisor
+
+
+def obtener_emisor_sesion_ligero(request: Request, db: Session) -> EmisorSesion:
+    """Como obtener_emisor_sesion, pero devuelve la tupla cacheada (id, ruc,
+    razon_social, plan): para páginas que no necesitan el Emisor completo."""
+    emisor = emisor_sesion_por_id(db, payload_sesion(request)["emisor_id"])
     if not emisor:
         raise HTTPException(status_code=404, detail="Emisor no encontrado")
-    
-    return emisor
\ No newline at end of file
+
+    return emisor
+
+
+async def obtener_emisor_actual(request: Request, db: Session) -> Emisor:
+    return obtener_emisor_sesion(request, db)
@@ -1,125 +1,123 @@
 """
 API de Clientes
 """
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
-from fastapi.requests import Request as FastAPIRequest
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Body, Request
+from fastapi.responses import ORJSONResponse, Response
 from sqlalchemy.orm import Session
-from sqlalchemy import or_
+from sqlalchemy import or_, func, literal_column, select, union_all
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from uuid import uuid4
 from datetime import datetime
-import csv
-import io
 
-from src.api.dependencies import get_db
-from src.models.models import Emisor, Cliente
+from src.api.dependencies import get_db, get_current_emisor_rw, EmisorSesion
+from src.api.paginacion import contar_estimado
+from src.api.etag import con_etag
+from src.api.importacion import leer_filas
+from src.models.models import Cliente, utc_now
 
-router = APIRouter(prefix="/api/clientes", tags=["clientes"])
+router = APIRouter(prefix="/api/clientes", tags=["clientes"], default_response_class=ORJSONResponse)
+
+
+def _filtro_busqueda(q: str):
+    """Filtro y orden de búsqueda: full-text (search_tsv, multi-palabra y con
+    ranking) con fallback ILIKE por subcadena (índices trigram)."""
+    tsquery = func.plainto_tsquery('simple', q)
+    filtro = or_(
+        Cliente.search_tsv.op('@@')(tsquery),
+        Cliente.numero_documento.ilike(f"%{q}%"),
+        Cliente.razon_social.ilike(f"%{q}%")
+    )
+    orden = (func.ts_rank_cd(Cliente.search_tsv, tsquery).desc(), Cliente.razon_social)
+    return filtro, orden
 
 
 @router.get("")
 def listar_clientes(
-    request: FastAPIRequest,
+    request: Request,
+    emisor: EmisorSesion = Depends(get_current_emisor_rw),
     db: Session = Depends(get_db),
     q: str = None,
     page: int = 1,
     limit: int = 50
 ):
     """Lista clientes del emisor"""
-    session_ruc = request.cookies.get("session")
-    if not session_ruc:
-        raise HTTPException(status_code=401, detail="No autorizado")
-    
-    emisor = db.query(Emisor).filter(Emisor.ruc == session_ruc).first()
-    if not emisor:
-        raise HTTPException(status_code=404, detail="Emisor no encontrado")
-    
     query = db.query(Cliente).filter(Cliente.emisor_id == emisor.id)
+    orden = (Cliente.razon_social,)
     
     if q:
-        query = query.filter(
-            or_(
-                Cliente.numero_documento.ilike(f"%{q}%"),
-                Cliente.razon_social.ilike(f"%{q}%")
-            )
-        )
+        filtro, orden = _filtro_busqueda(q)
+        query = query.filter(filtro)
     
-    total = query.count()
+    total, total_estimado = contar_estimado(query)
     offset = (page - 1) * limit
-    clientes = query.order_by(Cliente.razon_social).offset(offset).limit(limit).all()
+    clientes = query.with_entities(
+        Cliente.id, Cliente.tipo_documento, Cliente.numero_documento, Cliente.razon_social,
+        Cliente.direccion, Cliente.email, Cliente.telefono
+    ).order_by(*orden).offset(offset).limit(limit).all()
     
-    return {
+    # Filas planas (str/None): orjson directo, sin pasar por jsonable_encoder
+    return con_etag(request, ORJSONResponse({
         "exito": True,
-        "datos": [
-            {
-                "id": c.id,
-                "tipo_documento": c.tipo_documento,
-                "numero_documento": c.numero_documento,
-                "razon_social": c.razon_social,
-                "direccion": c.direccion,
-                "email": c.email,
-                "telefono": c.telefono
-            }
-            for c in clientes
-        ],
+        "datos": [dict(c._mapping) for c in clientes],
         "total": total,
+        "total_estimado": total_estimado,
         "page": page,
         "limit": limit
-    }
+    }))
 
 
 @router.get("/buscar")
 def buscar_clientes(
-    request: FastAPIRequest,
     q: str,
+    emisor: EmisorSesion = Depends(get_current_emisor_rw),
     db: Session = Depends(get_db)
 ):
     """Búsqueda rápida para formulario de emisión"""
-    session_ruc = request.cookies.get("session")
-    if not session_ruc:
-        raise HTTPException(status_code=401, detail="No autorizado")
-    
-    emisor = db.query(Emisor).filter(Emisor.ruc == session_ruc).first()
-    if not emisor:
-        raise HTTPException(status_code=404, detail="Emisor no encontrado")
-    
-    clientes = db.query(Cliente).filter(
-        Cliente.emisor_id == emisor.id,
-        or_(
+    # Un OR entre columnas suele dejar al planner con un solo índice (o seq scan):
+    # cada rama va aparte contra su propio índice GIN, con su LIMIT, y se unen.
+    tsquery = func.plainto_tsquery('simple', q)
+    rank = func.ts_rank_cd(Cliente.search_tsv, tsquery)
+    columnas = (
+        Cliente.id, Cliente.tipo_documento, Cliente.numero_documento, Cliente.razon_social,
+        Cliente.direccion, rank.label("rank")
+    )
+    ramas = [
+        select(*columnas).where(Cliente.emisor_id == emisor.id, condicion)
+        .order_by(rank.desc(), Cliente.razon_social).limit(10)
+        for condicion in (
+            Cliente.search_tsv.op('@@')(tsquery),
             Cliente.numero_documento.ilike(f"%{q}%"),
-            Cliente.razon_social.ilike(f"%{q}%")
+            Cliente.razon_social.ilike(f"%{q}%"),
         )
-    ).order_by(Cliente.razon_social).limit(10).all()
-    
-    return {
+    ]
+    union = union_all(*ramas).subquery()
+    filas = db.execute(
+        select(union).order_by(union.c.rank.desc(), union.c.razon_social)
+    ).all()
+    
+    # Un cliente puede venir por más de una rama: primera aparición, máximo 10
+    vistos = set()
+    clientes = []
+    for fila in filas:
+        if fila.id not in vistos:
+            vistos.add(fila.id)
+            clientes.append({k: v for k, v in fila._mapping.items() if k != "rank"})
+        if len(clientes) == 10:
+            break
+    
+    return ORJSONResponse({
         "exito": True,
-        "datos": [
-            {
-                "id": c.id,
-                "tipo_documento": c.tipo_documento,
-                "numero_documento": c.numero_documento,
-                "razon_social": c.razon_social,
-                "direccion": c.direccion
-            }
-            for c in clientes
-        ]
-    }
+        "datos": clientes
+    })
 
 
 @router.get("/{cliente_id}")
 def obtener_cliente(
     cliente_id: str,
-    request: FastAPIRequest,
+    emisor: EmisorSesion = Depends(get_current_emisor_rw),
     db: Session = Depends(get_db)
 ):
     """Obtiene un cliente por ID"""
-    session_ruc = request.cookies.get("session")
-    if not session_ruc:
-        raise HTTPException(status_code=401, detail="No autorizado")
-    
-    emisor = db.query(Emisor).filter(Emisor.ruc == session_ruc).first()
-    if not emisor:
-        raise HTTPException(status_code=404, detail="Emisor no encontrado")
-    
     cliente = db.query(Cliente).filter(
         Cliente.id == cliente_id,
         Cliente.emisor_id == emisor.id
@@ -144,21 +142,12 @@ def obtener_cliente(
 
 
 @router.post("")
-async def crear_cliente(
-    request: FastAPIRequest,
+def crear_cliente(
+    emisor: EmisorSesion = Depends(get_current_emisor_rw),
+    data: dict = Body(...),
     db: Session = Depends(get_db)
 ):
     """Crea un nuevo cliente"""
-    session_ruc = request.cookies.get("session")
-    if not session_ruc:
-        raise HTTPException(status_code=401, detail="No autorizado")
-    
-    emisor = db.query(Emisor).filter(Emisor.ruc == session_ruc).first()
-    if not emisor:
-        raise HTTPException(status_code=404, detail="Emisor no encontrado")
-    
-    data = await request.json()
-    
     if not data.get("numero_documento"):
         raise HTTPException(status_code=400, detail="El número de documento es requerido")
     
@@ -197,20 +186,13 @@ async def crear_cliente(
 
 
 @router.put("/{cliente_id}")
-async def actualizar_cliente(
+def actualizar_cliente(
     cliente_id: str,
-    request: FastAPIRequest,
+    emisor: EmisorSesion = Depends(get_current_emisor_rw),
+    data: dict = Body(...),
     db: Session = Depends(get_db)
 ):
     """Actualiza un cliente"""
-    session_ruc = request.cookies.get("session")
-    if not session_ruc:
-        raise HTTPException(status_code=401, detail="No autorizado")
-    
-    emisor = db.query(Emisor).filter(Emisor.ruc == session_ruc).first()
-    if not emisor:
-        raise HTTPException(status_code=404, detail="Emisor no encontrado")
-    
     cliente = db.query(Cliente).filter(
         Cliente.id == cliente_id,
         Cliente.emisor_id == emisor.id
@@ -219,8 +201,6 @@ async def actualizar_cliente(
     if not cliente:
         raise HTTPException(status_code=404, detail="Cliente no encontrado")
     
-    data = await request.json()
-    
     campos = ["tipo_documento", "numero_documento", "razon_social", "direccion", "ubigeo", "email", "telefono"]
     for campo in campos:
         if campo in data:
@@ -237,18 +217,10 @@ async def actualizar_cliente(
 @router.delete("/{cliente_id}")
 def eliminar_cliente(
     cliente_id: str,
-    request: FastAPIRequest,
+    emisor: EmisorSesion = Depends(get_current_emisor_rw),
     db: Session = Depends(get_db)
 ):
     """Elimina un cliente"""
-    session_ruc = request.cookies.get("session")
-    if not session_ruc:
-        raise HTTPException(status_code=401, detail="No autorizado")
-    
-    emisor = db.query(Emisor).filter(Emisor.ruc == session_ruc).first()
-    if not emisor:
-        raise HTTPException(status_code=404, detail="Emisor no encontrado")
-    
     cliente = db.query(Cliente).filter(
         Cliente.id == cliente_id,
         Cliente.emisor_id == emisor.id
@@ -266,41 +238,56 @@ def eliminar_cliente(
     }
 
 
+LOTE_IMPORTACION = 1000
+
+# Plantilla estática: se codifica una sola vez (BOM para que Excel detecte UTF-8)
+_PLANTILLA_BYTES = """ruc,razon_social,direccion,email,telefono
+20123456789,EMPRESA EJEMPLO SAC,Av. Principal 123,contacto@empresa.com,01-1234567
+10123456789,PERSONA NATURAL,Jr. Secundario 456,persona@email.com,987654321
+""".encode('utf-8-sig')
+
+
+def _upsert_clientes(db: Session, filas: list) -> tuple:
+    """INSERT ... ON CONFLICT (emisor_id, numero_documento) DO UPDATE de un lote.
+    Devuelve (insertados, actualizados); xmax = 0 solo en filas recién insertadas."""
+    importados = 0
+    actualizados = 0
+    stmt = pg_insert(Cliente).values(filas)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['emisor_id', 'numero_documento'],
+        set_={
+            "razon_social": stmt.excluded.razon_social,
+            "direccion": func.coalesce(stmt.excluded.direccion, Cliente.direccion),
+            "email": func.coalesce(stmt.excluded.email, Cliente.email),
+            "telefono": func.coalesce(stmt.excluded.telefono, Cliente.telefono),
+            "actualizado_en": stmt.excluded.actualizado_en,
+        }
+    ).returning(literal_column("xmax = 0"))
+    for (insertado,) in db.execute(stmt):
+        if insertado:
+            importados += 1
+        else:
+            actualizados += 1
+    return importados, actualizados
+
+
 @router.post("/importar")
-async def importar_clientes(
-    request: FastAPIRequest,
+def importar_clientes(
     archivo: UploadFile = File(...),
+    emisor: EmisorSesion = Depends(get_current_emisor_rw),
     db: Session = Depends(get_db)
 ):
     """Importa clientes desde CSV/Excel"""
-    session_ruc = request.cookies.get("session")
-    if not session_ruc:
-        raise HTTPException(status_code=401, detail="No autorizado")
-    
-    emisor = db.query(Emisor).filter(Emisor.ruc == session_ruc).first()
-    if not emisor:
-        raise HTTPException(status_code=404, detail="Emisor no encontrado")
-    
-    contenido = await archivo.read()
-    filename = archivo.filename.lower()
-    
     importados = 0
     actualizados = 0
     errores = []
     
     try:
-        if filename.endswith('.csv'):
-            texto = contenido.decode('utf-8-sig')
-            reader = csv.DictReader(io.StringIO(texto))
-            filas = list(reader)
-        elif filename.endswith(('.xlsx', '.xls')):
-            import pandas as pd
-            df = pd.read_excel(io.BytesIO(contenido))
-            filas = df.to_dict('records')
-        else:
-            raise HTTPException(status_code=400, detail="Formato no soportado")
-        
-        for i, fila in enumerate(filas, start=2):
+        # Un mismo documento repetido dentro del lote: gana la última fila
+        # (ON CONFLICT no puede tocar dos veces la misma fila en una sentencia).
+        lote = {}
+        ahora = utc_now()
+        for i, fila in enumerate(leer_filas(archivo), start=2):
             try:
                 fila_norm = {k.lower().strip().replace(' ', '_'): v for k, v in fila.items() if k}
                 
@@ -311,46 +298,35 @@ async def importar_clientes(
                     errores.append(f"Fila {i}: Documento o razón social vacío")
                     continue
                 
-                # Determinar tipo documento
-                tipo_doc = "6" if len(numero_doc) == 11 else "1"
-                
-                # Buscar existente
-                existente = db.query(Cliente).filter(
-                    Cliente.emisor_id == emisor.id,
-                    Cliente.numero_documento == numero_doc
-                ).first()
-                
-                direccion = str(fila_norm.get('direccion', '')).strip() or None
-                email = str(fila_norm.get('email', fila_norm.get('correo', ''))).strip() or None
-                telefono = str(fila_norm.get('telefono', fila_norm.get('celular', ''))).strip() or None
-                
-                if existente:
-                    existente.razon_social = razon_social
-                    if direccion:
-                        existente.direccion = direccion
-                    if email:
-                        existente.email = email
-                    if telefono:
-                        existente.telefono = telefono
-                    actualizados += 1
-                else:
-                    nuevo = Cliente(
-                        id=str(uuid4()),
-                        emisor_id=emisor.id,
-                        tipo_documento=tipo_doc,
-                        numero_documento=numero_doc,
-                        razon_social=razon_social,
-                        direccion=direccion,
-                        email=email,
-                        telefono=telefono
-                    )
-                    db.add(nuevo)
-                    importados += 1
+                lote[numero_doc] = {
+                    "id": str(uuid4()),
+                    "emisor_id": emisor.id,
+                    # Determinar tipo documento
+                    "tipo_documento": "6" if len(numero_doc) == 11 else "1",
+                    "numero_documento": numero_doc,
+                    "razon_social": razon_social,
+                    "direccion": str(fila_norm.get('direccion', '')).strip() or None,
+                    "email": str(fila_norm.get('email', fila_norm.get('correo', ''))).strip() or None,
+                    "telefono": str(fila_norm.get('telefono', fila_norm.get('celular', ''))).strip() or None,
+                    "activo": True,
+                    "creado_en": ahora,
+                    "actualizado_en": ahora,
+                }
                     
             except Exception as e:
                 errores.append(f"Fila {i}: {str(e)}")
                 continue
+            
+            if len(lote) >= LOTE_IMPORTACION:
+                ins, act = _upsert_clientes(db, list(lote.values()))
+                importados += ins
+                actualizados += act
+                lote = {}
         
+        if lote:
+            ins, act = _upsert_clientes(db, list(lote.values()))
+            importados += ins
+            actualizados += act
         db.commit()
         
         return {
@@ -368,15 +344,11 @@ async def importar_clientes(
 @router.get("/plantilla/descargar")
 def descargar_plantilla():
     """Descarga plantilla CSV"""
-    from fastapi.responses import StreamingResponse
-    
-    plantilla = """ruc,razon_social,direccion,email,telefono
-20123456789,EMPRESA EJEMPLO SAC,Av. Principal 123,contacto@empresa.com,01-1234567
-10123456789,PERSONA NATURAL,Jr. Secundario 456,persona@email.com,987654321
-"""
-    
-    return StreamingResponse(
-        io.StringIO(plantilla),
-        media_type="text/csv",
-        headers={"Content-Disposition": "attachment; filename=plantilla_clientes.csv"}
-    )
\ No newline at end of file
+    return Response(
+        _PLANTILLA_BYTES,
+        media_type="text/csv; charset=utf-8",
+        headers={
+            "Content-Disposition": "attachment; filename=plantilla_clientes.csv",
+            "Cache-Control": "public, max-age=86400"
+        }
+    )
@@ -1,12 +1,58 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import threading
+from collections import namedtuple
+
+from cachetools import TTLCache
+from fastapi import Depends, HTTPException, Request
+from sqlalchemy import create_engine, make_url
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import NullPool
 from src.core.config import settings
+from src.models.models import Emisor
+
+# Cuenta por proceso: workers * (pool_size + max_overflow) <= max_connections de Postgres.
+# pool_use_lifo reutiliza la conexión más reciente (caliente) y deja que las ociosas
+# expiren por pool_recycle.
+# Detrás de PgBouncer (transaction mode, puerto 6432): DB_NULL_POOL=true, el pool lo
+# lleva PgBouncer y aquí cada checkout abre/cierra contra él (barato, es local).
+_driver = make_url(settings.database_url).get_driver_name()
+# Detrás de PgBouncer no se manda `options` (lo rechaza salvo ignore_startup_parameters):
+# el timeout va en el rol, ALTER ROLE <usuario> SET statement_timeout = '30s'.
+_connect_args = {}
+if not settings.db_null_pool:
+    _connect_args["options"] = f"-c statement_timeout={settings.db_statement_timeout_ms}"
+_driver_args = {}
+# psycopg2 no tiene sentencias preparadas del lado del servidor; psycopg 3 sí.
+if settings.db_prepare_threshold is not None and _driver == "psycopg":
+    _connect_args["prepare_threshold"] = settings.db_prepare_threshold
+# psycopg2: los INSERT masivos ya van en VALUES multi-fila (insertmanyvalues); con
+# values_plus_batch los executemany de UPDATE (bulk_update_mappings) también se
+# agrupan con execute_batch en vez de un viaje por fila.
+if _driver == "psycopg2":
+    _driver_args = {
+        "executemany_mode": "values_plus_batch",
+        "executemany_batch_page_size": 500,
+        "insertmanyvalues_page_size": 1000,
+    }
+
+if settings.db_null_pool:
+    _pool_args = {"poolclass": NullPool}
+else:
+    _pool_args = {
+        "pool_size": settings.db_pool_size,
+        "max_overflow": settings.db_max_overflow,
+        "pool_timeout": settings.db_pool_timeout,
+        "pool_pre_ping": True,
+        "pool_recycle": settings.db_pool_recycle,
+        "pool_use_lifo": True,
+    }
 
 engine = create_engine(
     settings.database_url,
     future=True,
-    pool_pre_ping=True,
-    pool_recycle=300,
+    query_cache_size=settings.db_query_cache_size,
+    connect_args=_connect_args,
+    **_pool_args,
+    **_driver_args,
 )
 
 
@@ -18,3 +64,105 @@ def get_db():
         yield db
     finally:
         db.close()
+
+# Lecturas (páginas GET, listados): AUTOCOMMIT -> sin BEGIN/COMMIT por request,
+# y read-only a nivel de Postgres. Comparte el pool de `engine`; ambas opciones
+# se revierten al devolver la conexión al pool.
+# Con PgBouncer (transaction mode) sin read-only: es un SET de sesión
+# (default_transaction_read_only) que quedaría en la conexión del servidor y
+# haría fallar las escrituras del próximo cliente que la reciba.
+if settings.db_null_pool:
+    engine_ro = engine.execution_options(isolation_level="AUTOCOMMIT")
+else:
+    engine_ro = engine.execution_options(isolation_level="AUTOCOMMIT", postgresql_readonly=True)
+SessionLocalRO = sessionmaker(bind=engine_ro, autoflush=False, autocommit=False)
+
+def get_db_ro():
+    db = SessionLocalRO()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+# Emisor de la sesión (cookie "session" = RUC). Se cachea una tupla liviana y no la
+# instancia ORM: esta queda ligada a la Session del request que la cargó.
+EmisorSesion = namedtuple("EmisorSesion", "id ruc razon_social plan")
+
+_emisor_cache = TTLCache(maxsize=5000, ttl=60)
+# Páginas del dashboard (cookie session_token = JWT con emisor_id)
+_emisor_id_cache = TTLCache(maxsize=2048, ttl=30)
+_emisor_cache_lock = threading.Lock()
+
+
+def invalidar_emisor_cache(ruc: str, emisor_id: str = None):
+    """Descarta el emisor cacheado (llamar al cambiar plan / activar API)."""
+    with _emisor_cache_lock:
+        _emisor_cache.pop(ruc, None)
+        if emisor_id:
+            _emisor_id_cache.pop(emisor_id, None)
+
+
+def emisor_sesion_por_id(db: Session, emisor_id: str) -> EmisorSesion | None:
+    """EmisorSesion por id con cache TTL de 30 s; None si no existe."""
+    with _emisor_cache_lock:
+        emisor = _emisor_id_cache.get(emisor_id)
+    if emisor is not None:
+        return emisor
+
+    fila = db.query(Emisor.id, Emisor.ruc, Emisor.razon_social, Emisor.plan).filter(
+        Emisor.id == emisor_id
+    ).first()
+    if not fila:
+        return None
+    emisor = EmisorSesion(*fila)
+    with _emisor_cache_lock:
+        _emisor_id_cache[emisor_id] = emisor
+    return emisor
+
+
+def emisor_sesion_por_ruc(db: Session, ruc: str) -> EmisorSesion | None:
+    """EmisorSesion por RUC con cache TTL de 60 s; None si no existe."""
+    with _emisor_cache_lock:
+        emisor = _emisor_cache.get(ruc)
+    if emisor is not None:
+        return emisor
+
+    fila = db.query(Emisor.id, Emisor.ruc, Emisor.razon_social, Emisor.plan).filter(
+        Emisor.ruc == ruc
+    ).first()
+    if not fila:
+        return None
+    emisor = EmisorSesion(*fila)
+    with _emisor_cache_lock:
+        _emisor_cache[ruc] = emisor
+    return emisor
+
+
+def _emisor_de_cookie(request: Request, db: Session) -> EmisorSesion:
+    emisor = getattr(request.state, "emisor", None)
+    if emisor is not None:
+        return emisor
+
+    session_ruc = request.cookies.get("session")
+    if not session_ruc:
+        raise HTTPException(status_code=401, detail="No autorizado")
+
+    emisor = emisor_sesion_por_ruc(db, session_ruc)
+    if not emisor:
+        raise HTTPException(status_code=404, detail="Emisor no encontrado")
+
+    request.state.emisor = emisor
+    return emisor
+
+
+def get_current_emisor(request: Request, db: Session = Depends(get_db_ro)) -> EmisorSesion:
+    """Dependency: emisor de la cookie "session". Cache por request y por proceso (60 s).
+    Para handlers de lectura sobre get_db_ro (comparten la misma sesión)."""
+    return _emisor_de_cookie(request, db)
+
+
+def get_current_emisor_rw(request: Request, db: Session = Depends(get_db)) -> EmisorSesion:
+    """Como get_current_emisor, para handlers sobre get_db: FastAPI reutiliza la
+    sesión del handler y un fallo de cache no toma una segunda conexión (RO) del pool."""
+    return _emisor_de_cookie(request, db)
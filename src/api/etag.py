@@ -0,0 +1,28 @@
+"""
+ETag / 304 para respuestas de listados que el navegador vuelve a pedir seguido.
+
+El ETag es un hash del cuerpo ya renderizado: si coincide con If-None-Match se
+responde 304 sin cuerpo (el cliente reutiliza su copia). `private, no-cache`
+obliga a revalidar siempre y evita que un proxy comparta datos entre emisores.
+"""
+import hashlib
+
+from fastapi import Request
+from fastapi.responses import Response
+
+
+def etag_de(cuerpo: bytes) -> str:
+    return '"' + hashlib.blake2b(cuerpo, digest_size=16).hexdigest() + '"'
+
+
+def con_etag(request: Request, response: Response) -> Response:
+    """Agrega ETag a `response`; si el cliente ya tiene esa versión devuelve 304."""
+    etag = etag_de(response.body)
+    cabeceras = {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (e.strip() for e in if_none_match.split(",")):
+        return Response(status_code=304, headers=cabeceras)
+
+    response.headers.update(cabeceras)
+    return response
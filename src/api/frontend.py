@@ -1,26 +1,55 @@
 from fastapi import APIRouter, Request, Form, HTTPException, Depends
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
-from sqlalchemy.orm import Session
+from sqlalchemy import and_, event, func, tuple_
+from sqlalchemy.orm import Session, joinedload
+from cachetools import TTLCache
 from pathlib import Path
+import jinja2
+import logging
+import threading
 
-from datetime import datetime, timedelta
+from datetime import date, timedelta
 
-from src.models.models import Comprobante, Emisor, LineaDetalle
-from src.api.dependencies import get_db
-from src.api.auth_utils import obtener_emisor_actual
+from src.models.models import Comprobante, ComprobanteResumenDiario, Emisor, LineaDetalle, peru_now
+from src.api.dependencies import get_db_ro
+from src.api.auth_utils import obtener_emisor_sesion, obtener_emisor_sesion_ligero
+from src.api.paginacion import estimar_filas, UMBRAL_CONTEO_EXACTO
+from src.api.etag import con_etag
 
-# Configurar templates
+import os as _os
+from src.core.config import settings as _settings
+
+logger = logging.getLogger(__name__)
+
+# Configurar templates (instancia única: guias_ui, stock_ui, contadores,
+# importaciones_ui y registro importan este mismo objeto).
+# Con DEBUG apagado Jinja no hace stat() de cada plantilla por render, y el
+# bytecode cache (directorio temporal) evita re-parsearlas al reiniciar workers.
 templates_path = Path(__file__).parent.parent / "templates"
-templates = Jinja2Templates(directory=str(templates_path))
+templates = Jinja2Templates(env=jinja2.Environment(
+    loader=jinja2.FileSystemLoader(str(templates_path)),
+    autoescape=True,
+    auto_reload=_settings.debug,
+    cache_size=400,
+    bytecode_cache=jinja2.FileSystemBytecodeCache(),
+))
 
 # Cache-busting centralizado: APP_VERSION disponible como global en TODAS las
 # plantillas (instancia única). En cada deploy basta bumpear settings.APP_VERSION
 # o la variable de entorno APP_VERSION para invalidar el caché de CSS/JS propios.
-import os as _os
-from src.core.config import settings as _settings
 templates.env.globals["APP_VERSION"] = _os.getenv("APP_VERSION") or getattr(_settings, "APP_VERSION", "1")
 
+# Precompilar todas las plantillas al importar: el primer request de cada página no
+# paga el parseo y, sin auto_reload, get_template() queda en un lookup del cache.
+for _nombre in templates.env.list_templates(extensions=["html"]):
+    try:
+        templates.env.get_template(_nombre)
+    except Exception:
+        # Una plantilla rota no debe tumbar el arranque, pero sí quedar en el log:
+        # su request fallará igual.
+        logger.exception(f"Plantilla {_nombre} no compila")
+
 router = APIRouter()
 
 @router.get("/", response_class=HTMLResponse)
@@ -64,68 +93,93 @@ async def login_page(request: Request):
     )
 
 
+# Estadísticas del dashboard por (emisor_id, día): el F5 repetido no vuelve a
+# agregar. Se invalidan al insertar/actualizar/borrar un Comprobante por el ORM en
+# este proceso; lo que cambian otros procesos (Celery) se ve al vencer el TTL.
+_stats_cache = TTLCache(maxsize=4096, ttl=30)
+_stats_cache_lock = threading.Lock()
+
+
+@event.listens_for(Comprobante, "after_insert")
+@event.listens_for(Comprobante, "after_update")
+@event.listens_for(Comprobante, "after_delete")
+def _invalidar_stats_dashboard(mapper, connection, target):
+    with _stats_cache_lock:
+        _stats_cache.pop((target.emisor_id, peru_now().date()), None)
+
+
+def obtener_stats_dashboard(db: Session, emisor_id: str, hoy):
+    """Montos y contadores del dashboard en una sola pasada (sum FILTER) sobre
+    comprobante_resumen_diario: unas decenas de filas por emisor, no todo el detalle."""
+    clave = (emisor_id, hoy)
+    with _stats_cache_lock:
+        stats = _stats_cache.get(clave)
+    if stats is not None:
+        return stats
+    
+    inicio_semana = hoy - timedelta(days=hoy.weekday())
+    inicio_mes = hoy.replace(day=1)
+    R = ComprobanteResumenDiario
+    aceptado = R.estado == 'aceptado'
+    
+    def monto_si(condicion):
+        return func.coalesce(func.sum(R.monto_total).filter(condicion), 0)
+    
+    def cantidad_si(condicion):
+        return func.coalesce(func.sum(R.cantidad).filter(condicion), 0)
+    
+    stats = db.query(
+        # Montos (solo aceptados)
+        monto_si(and_(aceptado, R.fecha == hoy)).label("total_hoy"),
+        monto_si(and_(aceptado, R.fecha >= inicio_semana)).label("total_semana"),
+        monto_si(and_(aceptado, R.fecha >= inicio_mes)).label("total_mes"),
+        # Contadores por estado
+        cantidad_si(aceptado).label("count_aceptados"),
+        cantidad_si(R.estado == 'rechazado').label("count_rechazados"),
+        cantidad_si(R.estado == 'encolado').label("count_encolados"),
+        cantidad_si(R.estado.in_(['pendiente', 'enviando', 'encolado'])).label("count_pendientes"),
+        func.coalesce(func.sum(R.cantidad), 0).label("count_total"),
+        # Contadores por tipo
+        cantidad_si(R.tipo_documento == '01').label("count_facturas"),
+        cantidad_si(R.tipo_documento == '03').label("count_boletas"),
+        cantidad_si(R.tipo_documento == '07').label("count_nc"),
+        cantidad_si(R.tipo_documento == '08').label("count_nd"),
+        # Comprobantes hoy
+        cantidad_si(R.fecha == hoy).label("comprobantes_hoy"),
+    ).filter(R.emisor_id == emisor_id).one()
+    
+    with _stats_cache_lock:
+        _stats_cache[clave] = stats
+    return stats
+
+
 @router.get("/dashboard", response_class=HTMLResponse)
-async def dashboard(request: Request, db: Session = Depends(get_db)):
+def dashboard(request: Request, db: Session = Depends(get_db_ro)):
     """Dashboard principal con estadísticas"""
-    from datetime import datetime, timedelta, timezone
-    from sqlalchemy import func
-    
     try:
-        emisor = await obtener_emisor_actual(request, db)
+        emisor = obtener_emisor_sesion(request, db, joinedload(Emisor.certificado_activo))
     except:
         return RedirectResponse(url="/login")
     
-    # Zona horaria Perú
-    peru_tz = timezone(timedelta(hours=-5))
-    hoy = datetime.now(peru_tz).date()
-    inicio_semana = hoy - timedelta(days=hoy.weekday())
-    inicio_mes = hoy.replace(day=1)
+    hoy = peru_now().date()  # Fecha en Perú
     
     # Query base
     base_query = db.query(Comprobante).filter(Comprobante.emisor_id == emisor.id)
     
-    # === ESTADÍSTICAS DE MONTOS ===
-    
-    # Total hoy
-    total_hoy = db.query(func.coalesce(func.sum(Comprobante.monto_total), 0)).filter(
-        Comprobante.emisor_id == emisor.id,
-        Comprobante.fecha_emision == hoy,
-        Comprobante.estado == 'aceptado'
-    ).scalar() or 0
-    
-    # Total semana
-    total_semana = db.query(func.coalesce(func.sum(Comprobante.monto_total), 0)).filter(
-        Comprobante.emisor_id == emisor.id,
-        Comprobante.fecha_emision >= inicio_semana,
-        Comprobante.estado == 'aceptado'
-    ).scalar() or 0
-    
-    # Total mes
-    total_mes = db.query(func.coalesce(func.sum(Comprobante.monto_total), 0)).filter(
-        Comprobante.emisor_id == emisor.id,
-        Comprobante.fecha_emision >= inicio_mes,
-        Comprobante.estado == 'aceptado'
-    ).scalar() or 0
-    
-    # === CONTADORES POR ESTADO ===
-    
-    count_aceptados = base_query.filter(Comprobante.estado == 'aceptado').count()
-    count_rechazados = base_query.filter(Comprobante.estado == 'rechazado').count()
-    count_pendientes = base_query.filter(Comprobante.estado.in_(['pendiente', 'enviando', 'encolado'])).count()
-    count_total = base_query.count()
-    
-    # === CONTADORES POR TIPO ===
+    # === ESTADÍSTICAS (una consulta agregada, cacheada 30 s) ===
     
-    count_facturas = base_query.filter(Comprobante.tipo_documento == '01').count()
-    count_boletas = base_query.filter(Comprobante.tipo_documento == '03').count()
-    count_nc = base_query.filter(Comprobante.tipo_documento == '07').count()
-    count_nd = base_query.filter(Comprobante.tipo_documento == '08').count()
+    stats = obtener_stats_dashboard(db, emisor.id, hoy)
     
-    # === COMPROBANTES HOY ===
-    
-    comprobantes_hoy = base_query.filter(
-        Comprobante.fecha_emision == hoy
-    ).count()
+    total_hoy, total_semana, total_mes = stats.total_hoy, stats.total_semana, stats.total_mes
+    count_aceptados = stats.count_aceptados
+    count_rechazados = stats.count_rechazados
+    count_pendientes = stats.count_pendientes
+    count_total = stats.count_total
+    count_facturas = stats.count_facturas
+    count_boletas = stats.count_boletas
+    count_nc = stats.count_nc
+    count_nd = stats.count_nd
+    comprobantes_hoy = stats.comprobantes_hoy
     
     # === ÚLTIMOS 5 COMPROBANTES ===
     
@@ -137,11 +191,10 @@ async def dashboard(request: Request, db: Session = Depends(get_db)):
     
     certificado = None
     certificado_dias_restantes = None
-    if emisor.certificados:
-        cert = next((c for c in emisor.certificados if c.activo), None)
-        if cert and cert.fecha_vencimiento:
-            certificado = cert
-            certificado_dias_restantes = (cert.fecha_vencimiento - hoy).days
+    cert = emisor.certificado_activo
+    if cert and cert.fecha_vencimiento:
+        certificado = cert
+        certificado_dias_restantes = (cert.fecha_vencimiento - hoy).days
     
     return templates.TemplateResponse(
         "dashboard/dashboard.html",
@@ -183,19 +236,22 @@ async def logout():
     return response
 
 @router.get("/comprobantes", response_class=HTMLResponse)
-async def comprobantes_lista(
+def comprobantes_lista(
     request: Request,
     estado: str = None,
     fecha_desde: str = None,
     fecha_hasta: str = None,
     buscar: str = None,
     page: int = 1,
-    db: Session = Depends(get_db)
+    after_fecha: str = None,
+    after_numero: int = None,
+    after_id: str = None,
+    db: Session = Depends(get_db_ro)
 ):
     """Lista de comprobantes con filtros"""
     # Verificar sesión
     try:
-        emisor = await obtener_emisor_actual(request, db)
+        emisor = obtener_emisor_sesion_ligero(request, db)
     except:
         return RedirectResponse(url="/login")
     
@@ -206,13 +262,14 @@ async def comprobantes_lista(
     if estado:
         query = query.filter(Comprobante.estado == estado)
     
-    if fecha_desde:
-        fecha_desde_obj = datetime.strptime(fecha_desde, "%Y-%m-%d").date()
-        query = query.filter(Comprobante.fecha_emision >= fecha_desde_obj)
-    
-    if fecha_hasta:
-        fecha_hasta_obj = datetime.strptime(fecha_hasta, "%Y-%m-%d").date()
-        query = query.filter(Comprobante.fecha_emision <= fecha_hasta_obj)
+    try:
+        if fecha_desde:
+            query = query.filter(Comprobante.fecha_emision >= date.fromisoformat(fecha_desde))
+        
+        if fecha_hasta:
+            query = query.filter(Comprobante.fecha_emision <= date.fromisoformat(fecha_hasta))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Fecha inválida (use AAAA-MM-DD)")
     
     if buscar:
         query = query.filter(
@@ -220,36 +277,69 @@ async def comprobantes_lista(
             (Comprobante.numero_formato.ilike(f"%{buscar}%"))
         )
     
-    # Paginación
+    # Paginación. "Siguiente" viaja por keyset: (fecha, numero, id) < cursor usa el
+    # índice (emisor_id, fecha_emision DESC, numero DESC) y la página N cuesta lo
+    # mismo que la 1. Sin cursor (primera página, "Anterior") sigue con OFFSET.
     per_page = 20
-    total = query.count()
-    total_pages = (total + per_page - 1) // per_page
-    
-    comprobantes = query.order_by(
-        Comprobante.fecha_emision.desc(),
-        Comprobante.numero.desc()
-    ).offset((page - 1) * per_page).limit(per_page).all()
+    orden = (Comprobante.fecha_emision.desc(), Comprobante.numero.desc(), Comprobante.id.desc())
+    cursor = None
+    if after_fecha and after_numero is not None and after_id:
+        try:
+            cursor = (date.fromisoformat(after_fecha), after_numero, after_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Fecha inválida (use AAAA-MM-DD)")
+    
+    pagina = query
+    offset = (page - 1) * per_page
+    if cursor:
+        pagina = query.filter(
+            tuple_(Comprobante.fecha_emision, Comprobante.numero, Comprobante.id) < cursor
+        )
+        offset = 0
     
-    # Calcular estadísticas
-    base_query = db.query(Comprobante).filter(Comprobante.emisor_id == emisor.id)
+    estimado = estimar_filas(query)
+    total_estimado = estimado is not None and estimado >= UMBRAL_CONTEO_EXACTO
     
-    total_hoy = base_query.filter(
-        Comprobante.fecha_emision == datetime.now().date()
-    ).count()
+    # Solo las columnas que pinta la tabla (filas livianas, sin hidratar el ORM)
+    columnas = (
+        Comprobante.id, Comprobante.tipo_documento, Comprobante.serie, Comprobante.numero,
+        Comprobante.fecha_emision, Comprobante.cliente_numero_documento,
+        Comprobante.cliente_razon_social, Comprobante.monto_base, Comprobante.monto_total,
+        Comprobante.estado,
+    )
     
-    total_encolados = base_query.filter(
-        Comprobante.estado == 'encolado'
-    ).count()
+    if total_estimado or cursor:
+        # Conjunto grande: basta el total del planner. Con cursor el OVER () contaría
+        # solo lo que queda después del cursor: el total se pide aparte.
+        total = estimado if total_estimado else query.count()
+        comprobantes = pagina.with_entities(*columnas).order_by(
+            *orden
+        ).offset(offset).limit(per_page).all()
+    else:
+        # La página y el total exacto en un solo viaje (count(*) OVER ())
+        filas = query.with_entities(*columnas, func.count().over().label("total")).order_by(
+            *orden
+        ).offset(offset).limit(per_page).all()
+        comprobantes = filas
+        if filas:
+            total = filas[0].total
+        else:
+            # Página fuera de rango (o sin resultados): no hay fila que traiga el total
+            total = query.count() if page > 1 else 0
+    siguiente = comprobantes[-1] if len(comprobantes) == per_page else None
+    total_pages = (total + per_page - 1) // per_page
     
-    total_rechazados = base_query.filter(
-        Comprobante.estado == 'rechazado'
-    ).count()
+    # Estadísticas: las mismas del dashboard (resumen diario, cacheadas 30 s)
+    stats = obtener_stats_dashboard(db, emisor.id, peru_now().date())
+    total_hoy, total_encolados, total_rechazados = (
+        stats.comprobantes_hoy, stats.count_encolados, stats.count_rechazados
+    )
     
     # Calcular rango de visualización
     inicio = ((page - 1) * per_page) + 1
     fin = min(page * per_page, total)  # Calcular aquí
     
-    return templates.TemplateResponse(
+    return con_etag(request, templates.TemplateResponse(
         "dashboard/comprobantes.html",
         {
             "request": request,
@@ -257,9 +347,11 @@ async def comprobantes_lista(
             "emisor": emisor,
             "comprobantes": comprobantes,
             "total": total,
+            "total_estimado": total_estimado,
             "page": page,
             "total_pages": total_pages,
             "per_page": per_page,
+            "siguiente": siguiente,
             "estado": estado,
             "fecha_desde": fecha_desde,
             "fecha_hasta": fecha_hasta,
@@ -270,14 +362,14 @@ async def comprobantes_lista(
             "inicio": inicio,      # AGREGAR
             "fin": fin             # AGREGAR
         }
-    )
+    ))
 
 
 @router.get("/clientes", response_class=HTMLResponse)
-async def clientes_page(request: Request, db: Session = Depends(get_db)):
+def clientes_page(request: Request, db: Session = Depends(get_db_ro)):
     """Página de clientes"""
     try:
-        emisor = await obtener_emisor_actual(request, db)
+        emisor = obtener_emisor_sesion_ligero(request, db)
     except:
         return RedirectResponse(url="/login")
     
@@ -296,10 +388,10 @@ async def clientes_page(request: Request, db: Session = Depends(get_db)):
 
 
 @router.get("/comprobantes/emitir", response_class=HTMLResponse)
-async def emitir_comprobante_page(request: Request, db: Session = Depends(get_db)):
+def emitir_comprobante_page(request: Request, db: Session = Depends(get_db_ro)):
     """Página para emitir nuevo comprobante"""
     try:
-        emisor = await obtener_emisor_actual(request, db)
+        emisor = obtener_emisor_sesion(request, db)
     except:
         return RedirectResponse(url="/login")
 
@@ -345,26 +437,20 @@ async def emitir_comprobante_page(request: Request, db: Session = Depends(get_db
 
 
 @router.get("/configuracion", response_class=HTMLResponse)
-async def configuracion_page(request: Request, db: Session = Depends(get_db)):
+def configuracion_page(request: Request, db: Session = Depends(get_db_ro)):
     """Página de configuración del emisor"""
-    from datetime import datetime, timedelta, timezone
-    
     try:
-        emisor = await obtener_emisor_actual(request, db)
+        emisor = obtener_emisor_sesion(request, db, joinedload(Emisor.certificado_activo))
     except:
         return RedirectResponse(url="/login")
     
-    # Zona horaria Perú
-    peru_tz = timezone(timedelta(hours=-5))
-    hoy = datetime.now(peru_tz).date()
+    hoy = peru_now().date()  # Fecha en Perú
     
     # Obtener certificado activo
-    certificado = None
+    certificado = emisor.certificado_activo
     certificado_dias_restantes = None
-    if emisor.certificados:
-        certificado = next((c for c in emisor.certificados if c.activo), None)
-        if certificado and certificado.fecha_vencimiento:
-            certificado_dias_restantes = (certificado.fecha_vencimiento - hoy).days
+    if certificado and certificado.fecha_vencimiento:
+        certificado_dias_restantes = (certificado.fecha_vencimiento - hoy).days
     
     return templates.TemplateResponse(
         "dashboard/configuracion.html",
@@ -380,10 +466,10 @@ async def configuracion_page(request: Request, db: Session = Depends(get_db)):
 
 
 @router.get("/comprobantes/nota-credito", response_class=HTMLResponse)
-async def nota_credito_page(request: Request, db: Session = Depends(get_db)):
+def nota_credito_page(request: Request, db: Session = Depends(get_db_ro)):
     """Página para emitir Nota de Crédito"""
     try:
-        emisor = await obtener_emisor_actual(request, db)
+        emisor = obtener_emisor_sesion_ligero(request, db)
     except:
         return RedirectResponse(url="/login")
     
@@ -408,10 +494,10 @@ async def nota_credito_page(request: Request, db: Session = Depends(get_db)):
 
 
 @router.get("/productos", response_class=HTMLResponse)
-async def productos_page(request: Request, db: Session = Depends(get_db)):
+def productos_page(request: Request, db: Session = Depends(get_db_ro)):
     """Página de productos/catálogo"""
     try:
-        emisor = await obtener_emisor_actual(request, db)
+        emisor = obtener_emisor_sesion_ligero(request, db)
     except:
         return RedirectResponse(url="/login")
     
@@ -0,0 +1,30 @@
+"""
+Lectura de archivos de importación (CSV / Excel) fila a fila.
+
+Compartido por /api/clientes/importar y /api/productos/importar: ninguno carga el
+archivo entero en memoria. El CSV se decodifica en streaming y el .xlsx se lee con
+openpyxl en modo read_only (parser SAX, sin DOM ni DataFrame).
+"""
+import codecs
+import csv
+
+from fastapi import HTTPException, UploadFile
+
+
+def leer_filas(archivo: UploadFile):
+    """Genera las filas del archivo como dicts (encabezado -> valor), sin cargarlo entero."""
+    filename = archivo.filename.lower()
+    if filename.endswith('.csv'):
+        yield from csv.DictReader(codecs.iterdecode(archivo.file, 'utf-8-sig'))
+    elif filename.endswith('.xlsx'):
+        from openpyxl import load_workbook
+        wb = load_workbook(archivo.file, read_only=True, data_only=True)
+        try:
+            filas = wb.active.iter_rows(values_only=True)
+            encabezados = [str(h) if h is not None else None for h in next(filas, ())]
+            for valores in filas:
+                yield {h: ('' if v is None else v) for h, v in zip(encabezados, valores)}
+        finally:
+            wb.close()
+    else:
+        raise HTTPException(status_code=400, detail="Formato no soportado. Use CSV o Excel (.xlsx)")
@@ -0,0 +1,47 @@
+"""
+Conteo de resultados para listados paginados.
+
+`query.count()` agrega todo el conjunto filtrado antes de pintar cada página: en
+emisores grandes domina la latencia. contar_estimado() pide primero al planner su
+estimación (EXPLAIN, sin ejecutar la consulta) y solo hace el COUNT exacto cuando
+el conjunto es chico (ahí es barato y el número exacto sí se nota en la UI).
+"""
+import logging
+from contextlib import nullcontext
+
+from sqlalchemy.orm import Query
+
+logger = logging.getLogger(__name__)
+
+UMBRAL_CONTEO_EXACTO = 5000
+
+
+def estimar_filas(query: Query) -> int | None:
+    """Filas que el planner estima para `query` (EXPLAIN FORMAT JSON). None si falla."""
+    db = query.session
+    compilado = query.statement.compile(
+        dialect=db.get_bind().dialect,
+        compile_kwargs={"render_postcompile": True},
+    )
+    conn = db.connection()
+    # Sesión transaccional (get_db): en un savepoint, así un EXPLAIN fallido solo
+    # revierte el savepoint y el COUNT de respaldo aún puede correr. En AUTOCOMMIT
+    # (get_db_ro) no hay transacción que proteger y SAVEPOINT fallaría siempre.
+    en_autocommit = conn.get_execution_options().get("isolation_level") == "AUTOCOMMIT"
+    try:
+        with nullcontext() if en_autocommit else db.begin_nested():
+            plan = conn.exec_driver_sql(
+                "EXPLAIN (FORMAT JSON) " + compilado.string, compilado.params
+            ).scalar()
+        return int(plan[0]["Plan"]["Plan Rows"])
+    except Exception as e:
+        logger.warning(f"EXPLAIN para conteo estimado falló: {e}")
+        return None
+
+
+def contar_estimado(query: Query, umbral: int = UMBRAL_CONTEO_EXACTO) -> tuple:
+    """Devuelve (total, es_estimado). COUNT exacto bajo `umbral`; si no, la estimación."""
+    estimado = estimar_filas(query)
+    if estimado is None or estimado < umbral:
+        return query.count(), False
+    return estimado, True
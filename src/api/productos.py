@@ -1,34 +1,149 @@
 """
 API de Productos y Catálogo
 """
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
+from fastapi import APIRouter, Body, Depends, HTTPException, UploadFile, File
 from fastapi.requests import Request as FastAPIRequest
+from fastapi.responses import Response
 from sqlalchemy.orm import Session
-from sqlalchemy import or_, distinct
+from sqlalchemy import Float, func, literal_column, or_, distinct, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from uuid import uuid4
+from cachetools import TTLCache
 from datetime import datetime
-import csv
-import io
+import threading
 
-from src.api.dependencies import get_db
-from src.api.auth_utils import obtener_emisor_actual
-from src.models.models import Emisor, Producto
+from src.api.dependencies import get_db, get_db_ro, get_current_emisor, get_current_emisor_rw, EmisorSesion
+from src.api.auth_utils import obtener_emisor_sesion_ligero
+from src.api.importacion import leer_filas
+from src.models.models import Producto, utc_now
 
 router = APIRouter(prefix="/api/productos", tags=["productos"])
 
+# Categorías por emisor: el formulario de productos las pide en cada carga y casi no
+# cambian. Se invalidan al crear/editar/eliminar/importar desde este proceso; lo que
+# cambie otro worker se ve al vencer el TTL.
+_categorias_cache = TTLCache(maxsize=1024, ttl=60)
+_categorias_cache_lock = threading.Lock()
+
+
+def _invalidar_categorias(emisor_id: str):
+    with _categorias_cache_lock:
+        _categorias_cache.pop(emisor_id, None)
+
+
+# Importación: filas por sentencia de upsert (~18 parámetros por fila: por debajo del
+# límite de 65535 binds de Postgres) y errores que se guardan como máximo
+LOTE_IMPORTACION = 2000
+MAX_ERRORES_IMPORTACION = 100
+
+# Plantilla estática: se codifica una sola vez (BOM para que Excel detecte UTF-8)
+_PLANTILLA_BYTES = """codigo,descripcion,precio_venta,precio_compra,stock,unidad_medida,categoria,marca
+PROD001,Producto de ejemplo 1,100.00,80.00,50,NIU,General,MarcaX
+PROD002,Servicio de consultoría,250.00,0,0,ZZ,Servicios,
+PROD003,Producto exonerado IGV,45.50,30.00,100,NIU,General,MarcaY
+""".encode('utf-8-sig')
+
+# Encabezados aceptados por campo (normalizados: minúsculas, espacios -> '_'),
+# en orden de preferencia: gana el primero presente en el archivo.
+_ALIAS_COLUMNAS = {
+    "codigo": ("codigo", "codigo_interno", "sku"),
+    "descripcion": ("descripcion", "nombre", "producto"),
+    "precio_venta": ("precio", "precio_venta", "pv"),
+    "precio_compra": ("costo", "precio_compra", "pc"),
+    "stock_actual": ("stock", "stock_actual", "cantidad"),
+    "unidad_medida": ("unidad", "unidad_medida", "um"),
+    "categoria": ("categoria",),
+    "marca": ("marca",),
+}
+# Clave que nunca está en una fila: fila.get(_SIN_COLUMNA, defecto) -> defecto.
+_SIN_COLUMNA = object()
+
+
+def _mapa_columnas(encabezados) -> dict:
+    """{campo: encabezado original del archivo}, resuelto una sola vez por archivo.
+    Los campos sin columna apuntan a _SIN_COLUMNA."""
+    normalizados = {h.lower().strip().replace(' ', '_'): h for h in encabezados if h}
+    mapa = {}
+    for campo, alias in _ALIAS_COLUMNAS.items():
+        mapa[campo] = next((normalizados[a] for a in alias if a in normalizados), _SIN_COLUMNA)
+    return mapa
+
+
+def _fnum(valor) -> float:
+    """Número de una celda: vacía (None, '' o solo espacios) -> 0.0; las celdas
+    numéricas de xlsx pasan directo. Un texto no numérico sigue levantando
+    ValueError, que se reporta como error de la fila."""
+    if valor is None:
+        return 0.0
+    if isinstance(valor, (int, float)):
+        return float(valor)
+    valor = str(valor).strip()
+    return float(valor) if valor else 0.0
+
+
+def _escribir_lote_productos(db: Session, emisor_id: str, lote: dict) -> tuple:
+    """INSERT ... ON CONFLICT (emisor_id, codigo_interno) DO UPDATE de un lote
+    {codigo: valores}, en una sola sentencia (uq_producto_emisor_codigo).
+    Devuelve (insertados, actualizados); xmax = 0 solo en filas recién insertadas."""
+    ahora = utc_now()
+    filas = [
+        {
+            "id": uuid4().hex,
+            "emisor_id": emisor_id,
+            "codigo_interno": codigo,
+            "categoria": None,
+            "marca": None,
+            "tipo_afectacion_igv": '10',
+            "afecto_igv": True,
+            "maneja_stock": valores["stock_actual"] > 0,
+            "activo": True,
+            "es_favorito": False,
+            "veces_usado": 0,
+            "creado_en": ahora,
+            "actualizado_en": ahora,
+            **valores,
+        }
+        for codigo, valores in lote.items()
+    ]
+    
+    stmt = pg_insert(Producto).values(filas)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['emisor_id', 'codigo_interno'],
+        set_={
+            "descripcion": stmt.excluded.descripcion,
+            "precio_venta": stmt.excluded.precio_venta,
+            "precio_compra": stmt.excluded.precio_compra,
+            "stock_actual": stmt.excluded.stock_actual,
+            "unidad_medida": stmt.excluded.unidad_medida,
+            # Categoría/marca vacías en el archivo no borran las existentes
+            "categoria": func.coalesce(stmt.excluded.categoria, Producto.categoria),
+            "marca": func.coalesce(stmt.excluded.marca, Producto.marca),
+            "actualizado_en": stmt.excluded.actualizado_en,
+        }
+    ).returning(literal_column("xmax = 0"))
+    
+    insertados = 0
+    actualizados = 0
+    for (insertado,) in db.execute(stmt):
+        if insertado:
+            insertados += 1
+        else:
+            actualizados += 1
+    return insertados, actualizados
+
 
 # =============================================
 # BUSCAR PRODUCTOS (autocomplete de emisión)
 # =============================================
 
 @router.get("/buscar")
-async def buscar_productos(request: FastAPIRequest, q: str = "", db: Session = Depends(get_db)):
+def buscar_productos(request: FastAPIRequest, q: str = "", db: Session = Depends(get_db_ro)):
     """Autocomplete: busca productos activos del emisor por codigo_interno o
     descripción (ilike), máx 10 resultados. JSON compacto para la emisión.
 
     Autentica con la cookie de sesión del dashboard (session_token, vía
-    obtener_emisor_actual), igual que /api/comprobantes/emitir."""
-    emisor = await obtener_emisor_actual(request, db)
+    obtener_emisor_sesion_ligero), igual que /api/comprobantes/emitir."""
+    emisor = obtener_emisor_sesion_ligero(request, db)
 
     q = (q or "").strip()
     query = db.query(Producto).filter(
@@ -71,8 +186,8 @@ async def buscar_productos(request: FastAPIRequest, q: str = "", db: Session = D
 
 @router.get("")
 def listar_productos(
-    request: FastAPIRequest,
-    db: Session = Depends(get_db),
+    emisor: EmisorSesion = Depends(get_current_emisor),
+    db: Session = Depends(get_db_ro),
     q: str = None,
     categoria: str = None,
     activo: bool = None,
@@ -81,14 +196,6 @@ def listar_productos(
     limit: int = 50
 ):
     """Lista productos del emisor con filtros y paginación"""
-    session_ruc = request.cookies.get("session")
-    if not session_ruc:
-        raise HTTPException(status_code=401, detail="No autorizado")
-    
-    emisor = db.query(Emisor).filter(Emisor.ruc == session_ruc).first()
-    if not emisor:
-        raise HTTPException(status_code=404, detail="Emisor no encontrado")
-    
     query = db.query(Producto).filter(Producto.emisor_id == emisor.id)
     
     # Filtros
@@ -117,7 +224,19 @@ def listar_productos(
     
     # Paginación
     offset = (page - 1) * limit
-    productos = query.order_by(
+    # Solo las columnas que se serializan: filas planas, sin hidratar objetos ORM.
+    # Los Numeric llegan ya como float (cast en SQL), sin Decimal -> float por fila.
+    def como_float(columna):
+        return func.coalesce(columna, 0).cast(Float).label(columna.key)
+    
+    productos = query.with_entities(
+        Producto.id, Producto.codigo_interno, Producto.codigo_barras, Producto.descripcion,
+        Producto.descripcion_corta, Producto.categoria, Producto.subcategoria, Producto.marca,
+        Producto.unidad_medida, como_float(Producto.precio_venta), como_float(Producto.precio_compra),
+        como_float(Producto.stock_actual), como_float(Producto.stock_minimo), Producto.maneja_stock,
+        Producto.afecto_igv, Producto.tipo_afectacion_igv, Producto.activo,
+        Producto.es_favorito, Producto.veces_usado
+    ).order_by(
         Producto.es_favorito.desc(),
         Producto.veces_usado.desc(),
         Producto.descripcion
@@ -125,30 +244,7 @@ def listar_productos(
     
     return {
         "exito": True,
-        "datos": [
-            {
-                "id": p.id,
-                "codigo_interno": p.codigo_interno,
-                "codigo_barras": p.codigo_barras,
-                "descripcion": p.descripcion,
-                "descripcion_corta": p.descripcion_corta,
-                "categoria": p.categoria,
-                "subcategoria": p.subcategoria,
-                "marca": p.marca,
-                "unidad_medida": p.unidad_medida,
-                "precio_venta": float(p.precio_venta or 0),
-                "precio_compra": float(p.precio_compra or 0),
-                "stock_actual": float(p.stock_actual or 0),
-                "stock_minimo": float(p.stock_minimo or 0),
-                "maneja_stock": p.maneja_stock,
-                "afecto_igv": p.afecto_igv,
-                "tipo_afectacion_igv": p.tipo_afectacion_igv,
-                "activo": p.activo,
-                "es_favorito": p.es_favorito,
-                "veces_usado": p.veces_usado
-            }
-            for p in productos
-        ],
+        "datos": [dict(p._mapping) for p in productos],
         "total": total,
         "page": page,
         "limit": limit,
@@ -163,18 +259,10 @@ def listar_productos(
 @router.get("/{producto_id}")
 def obtener_producto(
     producto_id: str,
-    request: FastAPIRequest,
+    emisor: EmisorSesion = Depends(get_current_emisor_rw),
     db: Session = Depends(get_db)
 ):
     """Obtiene un producto por ID"""
-    session_ruc = request.cookies.get("session")
-    if not session_ruc:
-        raise HTTPException(status_code=401, detail="No autorizado")
-    
-    emisor = db.query(Emisor).filter(Emisor.ruc == session_ruc).first()
-    if not emisor:
-        raise HTTPException(status_code=404, detail="Emisor no encontrado")
-    
     producto = db.query(Producto).filter(
         Producto.id == producto_id,
         Producto.emisor_id == emisor.id
@@ -217,20 +305,12 @@ def obtener_producto(
 # =============================================
 
 @router.post("")
-async def crear_producto(
-    request: FastAPIRequest,
+def crear_producto(
+    data: dict = Body(...),
+    emisor: EmisorSesion = Depends(get_current_emisor_rw),
     db: Session = Depends(get_db)
 ):
     """Crea un nuevo producto"""
-    session_ruc = request.cookies.get("session")
-    if not session_ruc:
-        raise HTTPException(status_code=401, detail="No autorizado")
-    
-    emisor = db.query(Emisor).filter(Emisor.ruc == session_ruc).first()
-    if not emisor:
-        raise HTTPException(status_code=404, detail="Emisor no encontrado")
-    
-    data = await request.json()
     
     # Validaciones
     if not data.get("descripcion"):
@@ -242,14 +322,6 @@ async def crear_producto(
     if not data.get("precio_venta") and data.get("precio_venta") != 0:
         raise HTTPException(status_code=400, detail="El precio de venta es requerido")
     
-    # Validar código único
-    existe = db.query(Producto).filter(
-        Producto.emisor_id == emisor.id,
-        Producto.codigo_interno == data["codigo_interno"]
-    ).first()
-    if existe:
-        raise HTTPException(status_code=400, detail=f"Ya existe un producto con código {data['codigo_interno']}")
-    
     # Determinar tipo IGV
     afecto_igv = data.get("afecto_igv", True)
     if afecto_igv:
@@ -257,8 +329,11 @@ async def crear_producto(
     else:
         tipo_igv = data.get("tipo_afectacion_igv", "20")  # Exonerado por defecto
     
-    producto = Producto(
-        id=str(uuid4()),
+    # Código único: un solo INSERT ... ON CONFLICT DO NOTHING sobre
+    # uq_producto_emisor_codigo en vez de SELECT previo + INSERT.
+    # Sin fila devuelta = el código ya existía.
+    stmt = pg_insert(Producto).values(
+        id=uuid4().hex,
         emisor_id=emisor.id,
         codigo_interno=data["codigo_interno"],
         codigo_sunat=data.get("codigo_sunat"),
@@ -281,15 +356,21 @@ async def crear_producto(
         activo=True,
         es_favorito=data.get("es_favorito", False),
         veces_usado=0
-    )
+    ).on_conflict_do_nothing(
+        index_elements=["emisor_id", "codigo_interno"]
+    ).returning(Producto.id)
     
-    db.add(producto)
+    producto_id = db.execute(stmt).scalar()
+    if producto_id is None:
+        db.rollback()
+        raise HTTPException(status_code=400, detail=f"Ya existe un producto con código {data['codigo_interno']}")
     db.commit()
+    _invalidar_categorias(emisor.id)
     
     return {
         "exito": True,
         "mensaje": "Producto creado correctamente",
-        "producto_id": producto.id
+        "producto_id": producto_id
     }
 
 
@@ -298,20 +379,13 @@ async def crear_producto(
 # =============================================
 
 @router.put("/{producto_id}")
-async def actualizar_producto(
+def actualizar_producto(
     producto_id: str,
-    request: FastAPIRequest,
+    data: dict = Body(...),
+    emisor: EmisorSesion = Depends(get_current_emisor_rw),
     db: Session = Depends(get_db)
 ):
     """Actualiza un producto"""
-    session_ruc = request.cookies.get("session")
-    if not session_ruc:
-        raise HTTPException(status_code=401, detail="No autorizado")
-    
-    emisor = db.query(Emisor).filter(Emisor.ruc == session_ruc).first()
-    if not emisor:
-        raise HTTPException(status_code=404, detail="Emisor no encontrado")
-    
     producto = db.query(Producto).filter(
         Producto.id == producto_id,
         Producto.emisor_id == emisor.id
@@ -320,8 +394,6 @@ async def actualizar_producto(
     if not producto:
         raise HTTPException(status_code=404, detail="Producto no encontrado")
     
-    data = await request.json()
-    
     # Validar código único si cambió
     if data.get("codigo_interno") and data["codigo_interno"] != producto.codigo_interno:
         existe = db.query(Producto).filter(
@@ -364,6 +436,7 @@ async def actualizar_producto(
         producto.stock_minimo = float(data["stock_minimo"])
     
     db.commit()
+    _invalidar_categorias(emisor.id)
     
     return {
         "exito": True,
@@ -378,28 +451,20 @@ async def actualizar_producto(
 @router.delete("/{producto_id}")
 def eliminar_producto(
     producto_id: str,
-    request: FastAPIRequest,
+    emisor: EmisorSesion = Depends(get_current_emisor_rw),
     db: Session = Depends(get_db)
 ):
     """Elimina (desactiva) un producto"""
-    session_ruc = request.cookies.get("session")
-    if not session_ruc:
-        raise HTTPException(status_code=401, detail="No autorizado")
-    
-    emisor = db.query(Emisor).filter(Emisor.ruc == session_ruc).first()
-    if not emisor:
-        raise HTTPException(status_code=404, detail="Emisor no encontrado")
-    
-    producto = db.query(Producto).filter(
-        Producto.id == producto_id,
-        Producto.emisor_id == emisor.id
-    ).first()
-    
-    if not producto:
+    # Un solo UPDATE (sin SELECT previo); rowcount 0 = no existe o es de otro emisor
+    resultado = db.execute(
+        update(Producto)
+        .where(Producto.id == producto_id, Producto.emisor_id == emisor.id)
+        .values(activo=False)
+    )
+    if resultado.rowcount == 0:
         raise HTTPException(status_code=404, detail="Producto no encontrado")
-    
-    producto.activo = False
     db.commit()
+    _invalidar_categorias(emisor.id)
     
     return {
         "exito": True,
@@ -414,33 +479,25 @@ def eliminar_producto(
 @router.post("/{producto_id}/favorito")
 def toggle_favorito(
     producto_id: str,
-    request: FastAPIRequest,
+    emisor: EmisorSesion = Depends(get_current_emisor_rw),
     db: Session = Depends(get_db)
 ):
     """Marca/desmarca producto como favorito"""
-    session_ruc = request.cookies.get("session")
-    if not session_ruc:
-        raise HTTPException(status_code=401, detail="No autorizado")
-    
-    emisor = db.query(Emisor).filter(Emisor.ruc == session_ruc).first()
-    if not emisor:
-        raise HTTPException(status_code=404, detail="Emisor no encontrado")
-    
-    producto = db.query(Producto).filter(
-        Producto.id == producto_id,
-        Producto.emisor_id == emisor.id
-    ).first()
-    
-    if not producto:
+    # Toggle en el servidor: UPDATE ... RETURNING trae el valor nuevo en el mismo viaje
+    es_favorito = db.execute(
+        update(Producto)
+        .where(Producto.id == producto_id, Producto.emisor_id == emisor.id)
+        .values(es_favorito=~func.coalesce(Producto.es_favorito, False))
+        .returning(Producto.es_favorito)
+    ).scalar()
+    if es_favorito is None:
         raise HTTPException(status_code=404, detail="Producto no encontrado")
-    
-    producto.es_favorito = not producto.es_favorito
     db.commit()
     
     return {
         "exito": True,
-        "es_favorito": producto.es_favorito,
-        "mensaje": "Agregado a favoritos" if producto.es_favorito else "Quitado de favoritos"
+        "es_favorito": es_favorito,
+        "mensaje": "Agregado a favoritos" if es_favorito else "Quitado de favoritos"
     }
 
 
@@ -449,107 +506,81 @@ def toggle_favorito(
 # =============================================
 
 @router.post("/importar")
-async def importar_productos(
-    request: FastAPIRequest,
+def importar_productos(
+    emisor: EmisorSesion = Depends(get_current_emisor_rw),
     archivo: UploadFile = File(...),
     db: Session = Depends(get_db)
 ):
     """Importa productos desde CSV/Excel"""
-    session_ruc = request.cookies.get("session")
-    if not session_ruc:
-        raise HTTPException(status_code=401, detail="No autorizado")
-    
-    emisor = db.query(Emisor).filter(Emisor.ruc == session_ruc).first()
-    if not emisor:
-        raise HTTPException(status_code=404, detail="Emisor no encontrado")
-    
-    contenido = await archivo.read()
-    filename = archivo.filename.lower()
-    
-    productos_importados = 0
-    productos_actualizados = 0
     errores = []
     
     try:
-        if filename.endswith('.csv'):
-            texto = contenido.decode('utf-8-sig')
-            reader = csv.DictReader(io.StringIO(texto))
-            filas = list(reader)
-        elif filename.endswith(('.xlsx', '.xls')):
-            import pandas as pd
-            df = pd.read_excel(io.BytesIO(contenido))
-            filas = df.to_dict('records')
-        else:
-            raise HTTPException(status_code=400, detail="Formato no soportado. Use CSV o Excel (.xlsx)")
+        # Todo el camino es streaming: filas del archivo (CSV decodificado al vuelo,
+        # xlsx con openpyxl read_only) -> lote de LOTE_IMPORTACION -> escritura en bloque.
+        # Un código repetido dentro del lote se fusiona (gana la última fila: ON CONFLICT
+        # no puede tocar dos veces la misma fila en una sentencia); repetido
+        # en un lote posterior ya existe en la BD y se actualiza. Ambos cuentan como
+        # actualización. Un solo commit al final.
+        productos_importados = 0
+        productos_actualizados = 0
+        lote = {}
+        col = None
         
-        for i, fila in enumerate(filas, start=2):
+        for i, fila in enumerate(leer_filas(archivo), start=2):
+            if col is None:
+                col = _mapa_columnas(fila.keys())
             try:
-                # Normalizar nombres de columnas
-                fila_norm = {k.lower().strip().replace(' ', '_'): v for k, v in fila.items() if k}
-                
-                codigo = str(fila_norm.get('codigo', fila_norm.get('codigo_interno', fila_norm.get('sku', '')))).strip()
-                descripcion = str(fila_norm.get('descripcion', fila_norm.get('nombre', fila_norm.get('producto', '')))).strip()
+                codigo = str(fila.get(col["codigo"], '')).strip()
+                descripcion = str(fila.get(col["descripcion"], '')).strip()
                 
                 if not descripcion:
-                    errores.append(f"Fila {i}: Descripción vacía")
+                    if len(errores) < MAX_ERRORES_IMPORTACION:
+                        errores.append(f"Fila {i}: Descripción vacía")
                     continue
                 
                 if not codigo:
-                    errores.append(f"Fila {i}: Código vacío")
+                    if len(errores) < MAX_ERRORES_IMPORTACION:
+                        errores.append(f"Fila {i}: Código vacío")
                     continue
                 
-                # Buscar existente por código
-                producto_existente = db.query(Producto).filter(
-                    Producto.emisor_id == emisor.id,
-                    Producto.codigo_interno == codigo
-                ).first()
-                
                 # Obtener valores
-                precio_venta = float(fila_norm.get('precio', fila_norm.get('precio_venta', fila_norm.get('pv', 0))) or 0)
-                precio_compra = float(fila_norm.get('costo', fila_norm.get('precio_compra', fila_norm.get('pc', 0))) or 0)
-                stock = float(fila_norm.get('stock', fila_norm.get('stock_actual', fila_norm.get('cantidad', 0))) or 0)
-                unidad = str(fila_norm.get('unidad', fila_norm.get('unidad_medida', fila_norm.get('um', 'NIU')))).strip().upper() or 'NIU'
-                categoria = str(fila_norm.get('categoria', '')).strip() or None
-                marca = str(fila_norm.get('marca', '')).strip() or None
+                valores = {
+                    "descripcion": descripcion,
+                    "precio_venta": _fnum(fila.get(col["precio_venta"])),
+                    "precio_compra": _fnum(fila.get(col["precio_compra"])),
+                    "stock_actual": _fnum(fila.get(col["stock_actual"])),
+                    "unidad_medida": str(fila.get(col["unidad_medida"], 'NIU')).strip().upper() or 'NIU',
+                }
+                categoria = str(fila.get(col["categoria"], '')).strip() or None
+                marca = str(fila.get(col["marca"], '')).strip() or None
+                if categoria:
+                    valores["categoria"] = categoria
+                if marca:
+                    valores["marca"] = marca
                 
-                if producto_existente:
-                    # Actualizar
-                    producto_existente.descripcion = descripcion
-                    producto_existente.precio_venta = precio_venta
-                    producto_existente.precio_compra = precio_compra
-                    producto_existente.stock_actual = stock
-                    producto_existente.unidad_medida = unidad
-                    if categoria:
-                        producto_existente.categoria = categoria
-                    if marca:
-                        producto_existente.marca = marca
+                if codigo in lote:
+                    lote[codigo].update(valores)
                     productos_actualizados += 1
                 else:
-                    # Crear nuevo
-                    nuevo = Producto(
-                        id=str(uuid4()),
-                        emisor_id=emisor.id,
-                        codigo_interno=codigo,
-                        descripcion=descripcion,
-                        unidad_medida=unidad,
-                        precio_venta=precio_venta,
-                        precio_compra=precio_compra,
-                        stock_actual=stock,
-                        categoria=categoria,
-                        marca=marca,
-                        tipo_afectacion_igv='10',
-                        afecto_igv=True,
-                        maneja_stock=stock > 0,
-                        activo=True
-                    )
-                    db.add(nuevo)
-                    productos_importados += 1
+                    lote[codigo] = valores
                     
             except Exception as e:
-                errores.append(f"Fila {i}: {str(e)}")
+                if len(errores) < MAX_ERRORES_IMPORTACION:
+                    errores.append(f"Fila {i}: {str(e)}")
                 continue
+            
+            if len(lote) >= LOTE_IMPORTACION:
+                ins, act = _escribir_lote_productos(db, emisor.id, lote)
+                productos_importados += ins
+                productos_actualizados += act
+                lote = {}
         
+        if lote:
+            ins, act = _escribir_lote_productos(db, emisor.id, lote)
+            productos_importados += ins
+            productos_actualizados += act
         db.commit()
+        _invalidar_categorias(emisor.id)
         
         return {
             "exito": True,
@@ -571,18 +602,13 @@ async def importar_productos(
 @router.get("/plantilla/descargar")
 def descargar_plantilla():
     """Descarga plantilla CSV para importación"""
-    from fastapi.responses import StreamingResponse
-    
-    plantilla = """codigo,descripcion,precio_venta,precio_compra,stock,unidad_medida,categoria,marca
-PROD001,Producto de ejemplo 1,100.00,80.00,50,NIU,General,MarcaX
-PROD002,Servicio de consultoría,250.00,0,0,ZZ,Servicios,
-PROD003,Producto exonerado IGV,45.50,30.00,100,NIU,General,MarcaY
-"""
-    
-    return StreamingResponse(
-        io.StringIO(plantilla),
-        media_type="text/csv",
-        headers={"Content-Disposition": "attachment; filename=plantilla_productos.csv"}
+    return Response(
+        _PLANTILLA_BYTES,
+        media_type="text/csv; charset=utf-8",
+        headers={
+            "Content-Disposition": "attachment; filename=plantilla_productos.csv",
+            "Cache-Control": "public, max-age=86400"
+        }
     )
 
 
@@ -592,25 +618,25 @@ PROD003,Producto exonerado IGV,45.50,30.00,100,NIU,General,MarcaY
 
 @router.get("/categorias/lista")
 def listar_categorias(
-    request: FastAPIRequest,
-    db: Session = Depends(get_db)
+    emisor: EmisorSesion = Depends(get_current_emisor),
+    db: Session = Depends(get_db_ro)
 ):
-    """Lista categorías únicas de los productos"""
-    session_ruc = request.cookies.get("session")
-    if not session_ruc:
-        raise HTTPException(status_code=401, detail="No autorizado")
-    
-    emisor = db.query(Emisor).filter(Emisor.ruc == session_ruc).first()
-    if not emisor:
-        raise HTTPException(status_code=404, detail="Emisor no encontrado")
+    """Lista categorías únicas de los productos (cacheadas 60 s por emisor)"""
+    with _categorias_cache_lock:
+        datos = _categorias_cache.get(emisor.id)
     
-    categorias = db.query(distinct(Producto.categoria)).filter(
-        Producto.emisor_id == emisor.id,
-        Producto.categoria.isnot(None),
-        Producto.categoria != ''
-    ).order_by(Producto.categoria).all()
+    if datos is None:
+        # DISTINCT servido por idx_producto_emisor_categoria (index-only scan)
+        categorias = db.query(distinct(Producto.categoria)).filter(
+            Producto.emisor_id == emisor.id,
+            Producto.categoria.isnot(None),
+            Producto.categoria != ''
+        ).order_by(Producto.categoria).all()
+        datos = [c[0] for c in categorias if c[0]]
+        with _categorias_cache_lock:
+            _categorias_cache[emisor.id] = datos
     
     return {
         "exito": True,
-        "datos": [c[0] for c in categorias if c[0]]
+        "datos": datos
     }
\ No newline at end of file
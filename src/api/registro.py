@@ -8,27 +8,31 @@ Router para el flujo completo de conversión:
   /mi-cuenta → Dashboard del usuario trial/activo
 
 Dependencias nuevas (agregar a requirements.txt):
-  pip install passlib[bcrypt] python-jose[cryptography] python-multipart
+  pip install passlib[bcrypt,argon2] python-jose[cryptography] python-multipart
 """
 from fastapi import APIRouter, Depends, HTTPException, Request, Form, Response
 from fastapi.responses import HTMLResponse, RedirectResponse
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy import exists, func
 from datetime import datetime, timedelta, timezone
 from decimal import Decimal
+from cachetools import TTLCache
 from uuid import uuid4
 import hashlib
 import secrets
 import re
 import json
 import os
+import threading
+import time
 
 # === IMPORTAR DESDE TU PROYECTO ===
 from src.api.dependencies import get_db
 from src.api.frontend import templates
 
 from src.models.models import Emisor
-from src.api.auth_utils import obtener_emisor_actual
+from src.api.auth_utils import obtener_emisor_actual, payload_sesion
 
 # === DEPENDENCIAS NUEVAS ===
 try:
@@ -36,7 +40,7 @@ try:
     from jose import jwt, JWTError
 except ImportError:
     raise ImportError(
-        "Instala: pip install passlib[bcrypt] python-jose[cryptography]"
+        "Instala: pip install passlib[bcrypt,argon2] python-jose[cryptography]"
     )
 
 router = APIRouter()
@@ -49,7 +53,32 @@ ALGORITHM = "HS256"
 TOKEN_EXPIRE_HOURS = 24 * 7  # 1 semana
 TRIAL_DAYS = 15
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Argon2id para hashes nuevos (parámetros mínimos recomendados por OWASP: 19 MiB,
+# t=2, p=1). Los bcrypt existentes siguen validando y se re-hashean a Argon2 en el
+# siguiente login correcto (deprecated="auto" + verify_and_update).
+# Hash y verify son CPU puro (decenas de ms): en handlers async van por
+# run_in_threadpool para no frenar el event loop.
+pwd_context = CryptContext(
+    schemes=["argon2", "bcrypt"],
+    deprecated="auto",
+    argon2__memory_cost=19456,
+    argon2__time_cost=2,
+    argon2__parallelism=1,
+)
+
+# Hash de relleno: si el usuario no existe se verifica contra él, para que el login
+# tarde lo mismo exista o no la cuenta (sin oráculo de tiempo para enumerar emails/RUC).
+_HASH_RELLENO = pwd_context.hash(secrets.token_urlsafe(16))
+
+# Throttle por proceso de logins fallidos en ventanas fijas de un minuto, con dos
+# claves: la IP de origen (10/minuto) y la cuenta (email/RUC, 10/minuto; rotar IPs
+# no lo evade). Pasado cualquiera de los dos máximos se rechaza sin verificar: el
+# relleno de credenciales no quema CPU en Argon2. La ventana es fija (un fallo no
+# la renueva): un bloqueo de cuenta dura como máximo lo que queda del minuto.
+MAX_LOGINS_FALLIDOS = 10
+VENTANA_LOGINS_SEG = 60
+_logins_fallidos = TTLCache(maxsize=10000, ttl=2 * VENTANA_LOGINS_SEG)
+_logins_fallidos_lock = threading.Lock()
 
 
 # ─────────────────────────────────────────────
@@ -80,44 +109,54 @@ def verificar_token(token: str) -> dict | None:
 
 def obtener_usuario_actual(request: Request, db: Session) -> Emisor | None:
     """Obtiene el emisor logueado desde la cookie de sesión"""
-    token = request.cookies.get("session_token")
-    if not token:
-        return None
-    payload = verificar_token(token)
-    if not payload:
-        return None
-    emisor_id = payload.get("emisor_id")
-    if not emisor_id:
+    # Mismo decode cacheado que obtener_emisor_actual (por request y entre requests)
+    try:
+        emisor_id = payload_sesion(request)["emisor_id"]
+    except HTTPException:
         return None
     return db.query(Emisor).filter(Emisor.id == emisor_id).first()
 
 
+# /api/validar-ruc lo llama en cada tecleo: prefijos y resultados son constantes
+# de módulo (sin tuplas nuevas por llamada).
+_PREFIJOS_RUC = frozenset({"10", "15", "17", "20"})
+_RUC_OK = (True, "")
+_RUC_LONGITUD = (False, "El RUC debe tener 11 dígitos")
+_RUC_NO_NUMERICO = (False, "El RUC solo debe contener números")
+_RUC_PREFIJO = (False, "RUC no válido. Debe iniciar con 10, 15, 17 o 20")
+
+
 def validar_ruc(ruc: str) -> tuple[bool, str]:
     """Validación básica de RUC peruano"""
     if not ruc or len(ruc) != 11:
-        return False, "El RUC debe tener 11 dígitos"
+        return _RUC_LONGITUD
     if not ruc.isdigit():
-        return False, "El RUC solo debe contener números"
-    if ruc[:2] not in ("10", "15", "17", "20"):
-        return False, "RUC no válido. Debe iniciar con 10, 15, 17 o 20"
-    return True, ""
+        return _RUC_NO_NUMERICO
+    if ruc[:2] not in _PREFIJOS_RUC:
+        return _RUC_PREFIJO
+    return _RUC_OK
+
+
+# Compilados una vez al importar (registro, restablecer y cambiar clave los usan)
+_MAYUSCULA_RE = re.compile(r'[A-Z]')
+_DIGITO_RE = re.compile(r'[0-9]')
+_EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
 
 
 def validar_password(password: str) -> tuple[bool, str]:
     """Validación de contraseña"""
     if len(password) < 8:
         return False, "La contraseña debe tener mínimo 8 caracteres"
-    if not re.search(r'[A-Z]', password):
+    if not _MAYUSCULA_RE.search(password):
         return False, "Debe contener al menos una mayúscula"
-    if not re.search(r'[0-9]', password):
+    if not _DIGITO_RE.search(password):
         return False, "Debe contener al menos un número"
     return True, ""
 
 
 def validar_email(email: str) -> tuple[bool, str]:
     """Validación básica de email"""
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    if not re.match(pattern, email):
+    if not _EMAIL_RE.match(email):
         return False, "Email no válido"
     return True, ""
 
@@ -207,7 +246,7 @@ async def procesar_registro(
         })
 
     # 5. RUC duplicado
-    existe_ruc = db.query(Emisor).filter(Emisor.ruc == ruc.strip()).first()
+    existe_ruc = db.query(exists().where(Emisor.ruc == ruc.strip())).scalar()
     if existe_ruc:
         return templates.TemplateResponse("registro.html", {
             "request": request,
@@ -216,9 +255,9 @@ async def procesar_registro(
         })
 
     # 6. Email duplicado
-    existe_email = db.query(Emisor).filter(
-        func.lower(Emisor.email) == email.strip().lower()
-    ).first()
+    existe_email = db.query(
+        exists().where(func.lower(Emisor.email) == email.strip().lower())
+    ).scalar()
     if existe_email:
         return templates.TemplateResponse("registro.html", {
             "request": request,
@@ -230,11 +269,11 @@ async def procesar_registro(
     api_key, api_secret, api_secret_hash = generar_api_credentials()
 
     nuevo_emisor = Emisor(
-        id=str(uuid4()),
+        id=uuid4().hex,
         ruc=ruc.strip(),
         razon_social=razon_social.strip(),
         email=email.strip().lower(),
-        password_hash=pwd_context.hash(password[:72]),
+        password_hash=await run_in_threadpool(pwd_context.hash, password[:72]),
         nombre_contacto=nombre_contacto.strip(),
         telefono=telefono.strip(),
         # API credentials
@@ -253,10 +292,18 @@ async def procesar_registro(
         activo=True,
     )
 
+    # Todos los campos se asignan en Python: no hace falta db.refresh(). Los datos del
+    # token se toman antes del commit, que expira el objeto (leerlos después
+    # dispararía el mismo SELECT que refresh).
+    datos_token = {
+        "emisor_id": nuevo_emisor.id,
+        "ruc": nuevo_emisor.ruc,
+        "email": nuevo_emisor.email
+    }
+
     try:
         db.add(nuevo_emisor)
         db.commit()
-        db.refresh(nuevo_emisor)
     except Exception as e:
         db.rollback()
         return templates.TemplateResponse("registro.html", {
@@ -266,11 +313,7 @@ async def procesar_registro(
         })
 
     # --- Login automático después del registro ---
-    token = crear_token({
-        "emisor_id": nuevo_emisor.id,
-        "ruc": nuevo_emisor.ruc,
-        "email": nuevo_emisor.email
-    })
+    token = crear_token(datos_token)
 
     # Redirigir al dashboard trial con el api_secret visible (solo esta vez)
     response = RedirectResponse(
@@ -313,26 +356,49 @@ async def procesar_login(
     db: Session = Depends(get_db)
 ):
     """Procesa el login"""
-    # Buscar por email O por RUC
-    emisor = db.query(Emisor).filter(
-        (func.lower(Emisor.email) == email.strip().lower()) |
-        (Emisor.ruc == email.strip())
-    ).first()
-
-    if not emisor or not emisor.password_hash:
+    # Buscar por email O por RUC. Un RUC nunca lleva '@': se elige la rama antes de
+    # consultar y cada una usa su índice (idx_emisor_email_lower / único de ruc).
+    usuario = email.strip()
+    if "@" in usuario:
+        filtro = func.lower(Emisor.email) == usuario.lower()
+    else:
+        filtro = Emisor.ruc == usuario
+    ventana = int(time.time() // VENTANA_LOGINS_SEG)
+    ip = request.client.host if request.client else ""
+    claves_intentos = (("ip", ip, ventana), ("cuenta", usuario.lower(), ventana))
+
+    with _logins_fallidos_lock:
+        bloqueado = any(
+            _logins_fallidos.get(clave, 0) >= MAX_LOGINS_FALLIDOS for clave in claves_intentos
+        )
+    if bloqueado:
         return templates.TemplateResponse("login.html", {
             "request": request,
-            "error": "Email/RUC o contraseña incorrectos",
+            "error": "Demasiados intentos fallidos. Espere unos minutos e intente de nuevo.",
             "mensaje": ""
         })
 
-    if not pwd_context.verify(password[:72], emisor.password_hash):
+    emisor = db.query(Emisor).filter(filtro).first()
+    password_hash = emisor.password_hash if emisor and emisor.password_hash else _HASH_RELLENO
+
+    valido, nuevo_hash = await run_in_threadpool(
+        pwd_context.verify_and_update, password[:72], password_hash
+    )
+    if password_hash is _HASH_RELLENO or not valido:
+        with _logins_fallidos_lock:
+            for clave in claves_intentos:
+                _logins_fallidos[clave] = _logins_fallidos.get(clave, 0) + 1
         return templates.TemplateResponse("login.html", {
             "request": request,
             "error": "Email/RUC o contraseña incorrectos",
             "mensaje": ""
         })
 
+    if nuevo_hash:
+        # Hash heredado (bcrypt): migrar a Argon2 ahora que tenemos la clave en claro
+        emisor.password_hash = nuevo_hash
+        db.commit()
+
     # Crear token de sesión
     token = crear_token({
         "emisor_id": emisor.id,
@@ -523,7 +589,7 @@ async def procesar_restablecer_clave(
     ).first()
 
     if emisor:
-        emisor.password_hash = pwd_context.hash(password[:72])
+        emisor.password_hash = await run_in_threadpool(pwd_context.hash, password[:72])
         db.commit()
 
     return RedirectResponse(
@@ -547,7 +613,7 @@ async def cambiar_clave(
     if not emisor:
         return RedirectResponse(url="/login", status_code=303)
 
-    if not pwd_context.verify(clave_actual[:72], emisor.password_hash):
+    if not await run_in_threadpool(pwd_context.verify, clave_actual[:72], emisor.password_hash):
         # Redirigir con error
         return RedirectResponse(
             url="/mi-cuenta?error_clave=La contraseña actual es incorrecta",
@@ -567,7 +633,7 @@ async def cambiar_clave(
             status_code=303
         )
 
-    emisor.password_hash = pwd_context.hash(clave_nueva[:72])
+    emisor.password_hash = await run_in_threadpool(pwd_context.hash, clave_nueva[:72])
     db.commit()
 
     return RedirectResponse(
@@ -587,7 +653,8 @@ async def api_validar_ruc(ruc: str, db: Session = Depends(get_db)):
         return {"valido": False, "error": error}
 
     # Verificar si ya existe
-    existe = db.query(Emisor).filter(Emisor.ruc == ruc).first()
+    # EXISTS: solo un booleano, sin traer ni hidratar la fila del emisor
+    existe = db.query(exists().where(Emisor.ruc == ruc)).scalar()
     if existe:
         return {"valido": False, "error": "Este RUC ya está registrado"}
 
@@ -1,33 +1,41 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form
-from fastapi.responses import StreamingResponse, Response
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Body, Depends, HTTPException, UploadFile, File, Form
+from fastapi.responses import Response
+from sqlalchemy.orm import Session, joinedload, selectinload
 from fastapi import Request as FastAPIRequest
 from fastapi import Cookie, Request, Response
 
 from fastapi import UploadFile, File
 from fastapi.responses import Response
 
-from sqlalchemy import or_
+from sqlalchemy import and_, func, insert, or_, select, tuple_, update
 
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.serialization import pkcs12
 from cryptography.hazmat.backends import default_backend
 from cryptography import x509
 import base64
+import importlib.util
 
 from datetime import datetime, date, timedelta, timezone
+from functools import lru_cache
 import io
 
 import pandas as pd
 from uuid import uuid4
-from decimal import Decimal
+from decimal import Decimal, ROUND_HALF_UP
 
 from pydantic import BaseModel
 
-from src.api.dependencies import get_db
-from src.models.models import Comprobante, LineaDetalle, Emisor, Certificado, LogEnvio, RespuestaSunat, Cliente, Producto
+from src.api.dependencies import get_db, emisor_sesion_por_ruc
+from src.models.models import Comprobante, LineaDetalle, Emisor, Certificado, LogEnvio, Cliente, Producto
 from src.services.sunat_service import SunatService
-from src.api.auth_utils import obtener_emisor_actual
+from src.services.stock_service import descontar_por_comprobante, incrementar_uso
+from src.services.correlativo_service import siguiente_numero as siguiente_numero_correlativo
+from src.api.v1.pdf_generator import generar_pdf_comprobante
+from src.api.auth_utils import obtener_emisor_sesion
+from src.api.etag import etag_de
+from src.api.paginacion import contar_estimado
 
 # Verificar Celery disponible
 try:
@@ -38,6 +46,10 @@ except ImportError:
     CELERY_DISPONIBLE = False
     celery_app = None
 
+# Lector de Excel para pandas: calamine (Rust) si está instalado, varias veces más
+# rápido que openpyxl y también lee .xls. Si no, openpyxl como hasta ahora.
+EXCEL_ENGINE = "calamine" if importlib.util.find_spec("python_calamine") else "openpyxl"
+
 from src.schemas.schemas import ComprobanteCreate, StandardResponse
 
 from src.core.config import settings
@@ -78,8 +90,10 @@ def get_comprobante(comprobante_id: str, db: Session = Depends(get_db)):
 def descargar_xml(comprobante_id: str, db: Session = Depends(get_db)):
     """Descarga el XML del comprobante"""
     
-    # Buscar comprobante
-    comprobante = db.query(Comprobante).filter(Comprobante.id == comprobante_id).first()
+    # Buscar comprobante (con su emisor, para el nombre del archivo, en el mismo SELECT)
+    comprobante = db.query(Comprobante).options(
+        joinedload(Comprobante.emisor)
+    ).filter(Comprobante.id == comprobante_id).first()
     if not comprobante:
         raise HTTPException(status_code=404, detail="Comprobante no encontrado")
     
@@ -87,8 +101,7 @@ def descargar_xml(comprobante_id: str, db: Session = Depends(get_db)):
     if not comprobante.xml:
         raise HTTPException(status_code=404, detail="XML no disponible")
     
-    # Buscar emisor para el nombre del archivo
-    emisor = db.query(Emisor).filter(Emisor.id == comprobante.emisor_id).first()
+    emisor = comprobante.emisor
     
     # Construir nombre de archivo
     filename = f"{emisor.ruc}-{comprobante.tipo_documento}-{comprobante.serie}-{comprobante.numero}.xml"
@@ -103,25 +116,23 @@ def descargar_xml(comprobante_id: str, db: Session = Depends(get_db)):
 
 
 @router.get("/comprobantes/{comprobante_id}/cdr")
-async def descargar_cdr(comprobante_id: str, db: Session = Depends(get_db)):
+def descargar_cdr(comprobante_id: str, db: Session = Depends(get_db)):
     """Descarga el CDR (Constancia de Recepción) de SUNAT"""
-    from fastapi.responses import Response
     
-    # Buscar comprobante
-    comprobante = db.query(Comprobante).filter(Comprobante.id == comprobante_id).first()
+    # Buscar comprobante con emisor y respuesta SUNAT en un solo SELECT
+    comprobante = db.query(Comprobante).options(
+        joinedload(Comprobante.emisor),
+        joinedload(Comprobante.respuesta)
+    ).filter(Comprobante.id == comprobante_id).first()
     if not comprobante:
         raise HTTPException(status_code=404, detail="Comprobante no encontrado")
     
-    # Buscar respuesta SUNAT
-    respuesta = db.query(RespuestaSunat).filter(
-        RespuestaSunat.comprobante_id == comprobante_id
-    ).first()
-    
+    respuesta = comprobante.respuesta
     if not respuesta or not respuesta.cdr_xml:
         raise HTTPException(status_code=404, detail="CDR no disponible")
     
     # Construir nombre de archivo
-    filename = f"R-{comprobante.emisor_ruc}-{comprobante.tipo_comprobante}-{comprobante.serie}-{comprobante.numero}.xml"
+    filename = f"R-{comprobante.emisor.ruc}-{comprobante.tipo_documento}-{comprobante.serie}-{comprobante.numero}.xml"
     
     return Response(
         content=respuesta.cdr_xml.encode('utf-8') if isinstance(respuesta.cdr_xml, str) else respuesta.cdr_xml,
@@ -135,32 +146,36 @@ async def descargar_cdr(comprobante_id: str, db: Session = Depends(get_db)):
 @router.get("/comprobantes/{comprobante_id}/pdf")
 def descargar_pdf(comprobante_id: str, db: Session = Depends(get_db)):
     """Descarga el PDF del comprobante"""
-    from fastapi.responses import Response
-    from src.api.v1.pdf_generator import generar_pdf_comprobante
     
-    comprobante = db.query(Comprobante).filter(Comprobante.id == comprobante_id).first()
+    # Comprobante + emisor en un SELECT; las líneas con selectinload (un SELECT
+    # ... IN aparte): con joinedload cada fila de línea repetía el xml/pdf del
+    # comprobante y las columnas del emisor.
+    comprobante = db.query(Comprobante).options(
+        joinedload(Comprobante.emisor),
+        selectinload(Comprobante.lineas)
+    ).filter(Comprobante.id == comprobante_id).first()
     if not comprobante:
         raise HTTPException(status_code=404, detail="Comprobante no encontrado")
     
-    emisor = db.query(Emisor).filter(Emisor.id == comprobante.emisor_id).first()
+    emisor = comprobante.emisor
     if not emisor:
         raise HTTPException(status_code=404, detail="Emisor no encontrado")
     
-    items = db.query(LineaDetalle).filter(
-        LineaDetalle.comprobante_id == comprobante_id
-    ).all()
+    items = comprobante.lineas
     
+    # Por (emisor_id, numero_documento): usa uq_cliente_emisor_documento y no
+    # toma el cliente homónimo de otro emisor.
     cliente = db.query(Cliente).filter(
+        Cliente.emisor_id == comprobante.emisor_id,
         Cliente.numero_documento == comprobante.cliente_numero_documento
     ).first()
     
-    codigo_matricula = getattr(comprobante, 'codigo_matricula', None)
-    
     try:
+        # Comprobante no tiene columna codigo_matricula (el getattr previo siempre daba
+        # None); la matrícula en el PDF solo la arma la API v1 desde observaciones.
         pdf_bytes = generar_pdf_comprobante(
             comprobante, emisor, cliente, items,
             formato="A4",
-            codigo_matricula=codigo_matricula,
         )
         
         filename = f"{emisor.ruc}-{comprobante.tipo_documento}-{comprobante.serie}-{comprobante.numero}.pdf"
@@ -183,16 +198,25 @@ def buscar_comprobantes(
     tipo_comprobante: Optional[str] = None,
     limit: int = 50,
     offset: int = 0,
+    cursor_fecha: Optional[date] = None,
+    cursor_numero: Optional[int] = None,
+    cursor_id: Optional[str] = None,
     db: Session = Depends(get_db)
 ):
-    """Busca comprobantes con filtros"""
+    """Busca comprobantes con filtros.
+    Paginación por keyset: pasar el `next_cursor` de la respuesta anterior como
+    cursor_fecha / cursor_numero / cursor_id. `offset` queda para compatibilidad."""
     
     # Validar limit
     if limit > 100:
         limit = 100
     
+    emisor = emisor_sesion_por_ruc(db, emisor_ruc)
+    if not emisor:
+        raise HTTPException(status_code=404, detail="Emisor no encontrado")
+    
     # Query base
-    query = db.query(Comprobante).filter(Comprobante.emisor_ruc == emisor_ruc)
+    query = db.query(Comprobante).filter(Comprobante.emisor_id == emisor.id)
     
     # Aplicar filtros
     if fecha_desde:
@@ -204,17 +228,33 @@ def buscar_comprobantes(
     if estado:
         query = query.filter(Comprobante.estado == estado)
     if tipo_comprobante:
-        query = query.filter(Comprobante.tipo_comprobante == tipo_comprobante)
-    
-    # Total
-    total = query.count()
-    
-    # Paginación y orden
-    comprobantes = query.order_by(
+        query = query.filter(Comprobante.tipo_documento == tipo_comprobante)
+    
+    # Total: estimación del planner en conjuntos grandes (ver src/api/paginacion.py)
+    total, total_estimado = contar_estimado(query)
+    
+    # Paginación y orden. Con cursor, (fecha, numero, id) < cursor recorre el índice
+    # (emisor_id, fecha_emision DESC, numero DESC) sin saltar filas con OFFSET.
+    pagina = query
+    if cursor_fecha and cursor_numero is not None and cursor_id:
+        pagina = query.filter(
+            tuple_(Comprobante.fecha_emision, Comprobante.numero, Comprobante.id)
+            < (cursor_fecha, cursor_numero, cursor_id)
+        )
+        offset = 0
+    comprobantes = pagina.order_by(
         Comprobante.fecha_emision.desc(),
-        Comprobante.numero.desc()
+        Comprobante.numero.desc(),
+        Comprobante.id.desc()
     ).limit(limit).offset(offset).all()
     
+    ultimo = comprobantes[-1] if len(comprobantes) == limit else None
+    next_cursor = {
+        "cursor_fecha": ultimo.fecha_emision.isoformat(),
+        "cursor_numero": ultimo.numero,
+        "cursor_id": ultimo.id,
+    } if ultimo else None
+    
     # Formatear respuesta
     items = [
         {
@@ -224,7 +264,7 @@ def buscar_comprobantes(
             "fecha_emision": c.fecha_emision.strftime("%d/%m/%Y"),
             "monto_total": str(c.monto_total),
             "estado": c.estado,
-            "tipo_comprobante": c.tipo_comprobante,
+            "tipo_comprobante": c.tipo_documento,
             "cliente_razon_social": c.cliente_razon_social
         }
         for c in comprobantes
@@ -234,16 +274,18 @@ def buscar_comprobantes(
         "exito": True,
         "datos": {
             "total": total,
+            "total_estimado": total_estimado,
             "items": items,
             "limit": limit,
-            "offset": offset
+            "offset": offset,
+            "next_cursor": next_cursor
         },
         "mensaje": None
     }
 
 
 @router.post("/comprobantes/{comprobante_id}/reenviar")
-async def reenviar_comprobante(
+def reenviar_comprobante(
     comprobante_id: str,
     db: Session = Depends(get_db)
 ):
@@ -268,7 +310,6 @@ async def reenviar_comprobante(
     # Encolar tarea (usar la misma que emitir)
     try:
         if CELERY_DISPONIBLE:
-            from src.tasks.celery_app import celery_app
             celery_app.send_task('enviar_comprobante_sunat', args=[comprobante_id])
             return {
                 "exito": True,
@@ -276,7 +317,6 @@ async def reenviar_comprobante(
             }
         else:
             # Envío síncrono
-            from src.services.sunat_service import SunatService
             sunat = SunatService(db)
             resultado = sunat.enviar_comprobante(comprobante_id)
             return {
@@ -290,35 +330,37 @@ async def reenviar_comprobante(
         }
 
 
+# Comprobantes por lote en reenviar_todos_rechazados
+LOTE_REENVIO = 500
+
+
 @router.post("/comprobantes/reenviar-rechazados")
-async def reenviar_todos_rechazados(
+def reenviar_todos_rechazados(
     request: ReenviarRechazadosRequest,
     db: Session = Depends(get_db)
 ):
     """Reenviar todos los comprobantes rechazados de hoy"""
     
-    emisor = db.query(Emisor).filter(Emisor.ruc == request.emisor_ruc).first()
+    emisor = emisor_sesion_por_ruc(db, request.emisor_ruc)
     if not emisor:
         raise HTTPException(status_code=404, detail="Emisor no encontrado")
     
 
     limite_reintento = datetime.now() - timedelta(minutes=1)
+    ahora = datetime.now()
     
-    rechazados = (
-        db.query(Comprobante)
-        .filter(
-            Comprobante.emisor_id == emisor.id,
-            Comprobante.estado == "rechazado",
-            Comprobante.fecha_emision == date.today(),
-            or_(
-                Comprobante.ultimo_intento_envio.is_(None),
-                Comprobante.ultimo_intento_envio < limite_reintento,
-            ),
-        )
-        .all()
+    filtro = (
+        Comprobante.emisor_id == emisor.id,
+        Comprobante.estado == "rechazado",
+        Comprobante.fecha_emision == date.today(),
+        or_(
+            Comprobante.ultimo_intento_envio.is_(None),
+            Comprobante.ultimo_intento_envio < limite_reintento,
+        ),
     )
     
-    if not rechazados:
+    # Chequeo barato antes de tomar locks: SELECT 1 ... LIMIT 1
+    if db.query(Comprobante.id).filter(*filtro).limit(1).first() is None:
         # Verificar si hay algunos procesando
         procesando = db.query(Comprobante).filter(
             Comprobante.emisor_id == emisor.id,
@@ -339,51 +381,93 @@ async def reenviar_todos_rechazados(
                 "mensaje": "No hay comprobantes rechazados para reenviar"
             }
     
+    total = 0
     reenviados = 0
-    ahora = datetime.now()
-    
-    # Marcar todos como procesando PRIMERO
-    for comp in rechazados:
-        comp.estado = 'enviando'
-        comp.procesando_desde = ahora
-        comp.ultimo_intento_envio = ahora
-        comp.intentos_envio = (comp.intentos_envio or 0) + 1
-    
-    db.commit()
-    
-   # Luego encolar tareas
-    if CELERY_DISPONIBLE:
-        from src.tasks.celery_app import celery_app
-        for comp in rechazados:
-            try:
-                celery_app.send_task('enviar_comprobante_sunat', args=[comp.id])
-                reenviados += 1
-            except Exception as e:
-                print(f"Error encolando {comp.id}: {e}")
-                comp.estado = 'error'
-                comp.descripcion_respuesta = f"Error al encolar: {str(e)}"
-                comp.procesando_desde = None
-    else:
-        # Procesamiento síncrono
-        from src.services.sunat_service import SunatService
-        sunat_service = SunatService(db)
+    sunat_service = None if CELERY_DISPONIBLE else SunatService(db)
+    
+    # Por lotes de LOTE_REENVIO: cada lote se marca como procesando con un solo
+    # UPDATE ... RETURNING id (atómico; SKIP LOCKED evita que dos clics seguidos
+    # tomen las mismas filas), se confirma y se encola, así los workers empiezan
+    # con el primer lote mientras se toma el siguiente. Las filas tomadas dejan de
+    # cumplir `filtro` (estado 'enviando'), por eso el bucle termina.
+    while True:
+        ahora = datetime.now()
+        lote_ids = (
+            select(Comprobante.id)
+            .where(*filtro)
+            .limit(LOTE_REENVIO)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        lote = db.execute(
+            update(Comprobante)
+            .where(Comprobante.id.in_(lote_ids))
+            .values(
+                estado='enviando',
+                procesando_desde=ahora,
+                ultimo_intento_envio=ahora,
+                intentos_envio=func.coalesce(Comprobante.intentos_envio, 0) + 1,
+            )
+            .returning(Comprobante.id)
+            .execution_options(synchronize_session=False)
+        ).scalars().all()
+        if not lote:
+            break
+        db.commit()
+        total += len(lote)
+        
+        cambios = []    # UPDATE por clave primaria del lote (executemany)
         
-        for comp in rechazados:
+        # Luego encolar tareas
+        if CELERY_DISPONIBLE:
+            encolados = set()
+            errores = {}
             try:
-                resultado = sunat_service.enviar_comprobante(comp.id)
-                if resultado.get('exito'):
-                    reenviados += 1
+                # Un solo producer (conexión y canal al broker) para todas las
+                # publicaciones del lote, en vez de tomar uno del pool por tarea.
+                with celery_app.producer_or_acquire() as producer:
+                    for comp_id in lote:
+                        try:
+                            celery_app.send_task('enviar_comprobante_sunat', args=[comp_id], producer=producer)
+                            encolados.add(comp_id)
+                        except Exception as e:
+                            print(f"Error encolando {comp_id}: {e}")
+                            errores[comp_id] = str(e)
             except Exception as e:
-                print(f"Error procesando {comp.id}: {e}")
-                comp.estado = 'error'
-                comp.descripcion_respuesta = str(e)
-            finally:
-                comp.procesando_desde = None
-    
-    db.commit()
+                # Sin conexión al broker: lo no publicado queda con este error
+                print(f"Error conectando al broker: {e}")
+                for comp_id in lote:
+                    errores.setdefault(comp_id, str(e))
+            
+            reenviados += len(encolados)
+            for comp_id in lote:
+                if comp_id not in encolados:
+                    cambios.append({
+                        "id": comp_id,
+                        "estado": 'error',
+                        "descripcion_respuesta": f"Error al encolar: {errores[comp_id]}",
+                        "procesando_desde": None,
+                    })
+        else:
+            # Procesamiento síncrono
+            for comp_id in lote:
+                cambio = {"id": comp_id, "procesando_desde": None}
+                try:
+                    resultado = sunat_service.enviar_comprobante(comp_id)
+                    if resultado.get('exito'):
+                        reenviados += 1
+                except Exception as e:
+                    print(f"Error procesando {comp_id}: {e}")
+                    cambio["estado"] = 'error'
+                    cambio["descripcion_respuesta"] = str(e)
+                cambios.append(cambio)
+        
+        if cambios:
+            db.execute(update(Comprobante), cambios)
+        db.commit()
     
     modo = "asíncrono" if CELERY_DISPONIBLE else "síncrono"
-    tiempo_estimado = len(rechazados) * 5 if CELERY_DISPONIBLE else len(rechazados) * 5
+    tiempo_estimado = total * 5
     
     return {
         "exito": True,
@@ -393,10 +477,10 @@ async def reenviar_todos_rechazados(
     }
 
 
-@router.get("/clientes/template")
-def descargar_template_clientes():
-    """Descargar template Excel para importar clientes"""
-    
+@lru_cache(maxsize=1)
+def _template_clientes() -> tuple:
+    """(bytes, etag) del template Excel de clientes. Es contenido fijo: se genera
+    (pandas + openpyxl) la primera vez y luego se sirve desde memoria."""
     # Crear DataFrame con columnas
     df = pd.DataFrame(columns=[
         'tipo_documento',
@@ -416,17 +500,28 @@ def descargar_template_clientes():
     with pd.ExcelWriter(output, engine='openpyxl') as writer:
         df.to_excel(writer, index=False, sheet_name='Clientes')
     
-    output.seek(0)
+    contenido = output.getvalue()
+    return contenido, etag_de(contenido)
+
+
+@router.get("/clientes/template")
+def descargar_template_clientes(request: FastAPIRequest):
+    """Descargar template Excel para importar clientes"""
+    contenido, etag = _template_clientes()
+    cabeceras = {"ETag": etag, "Cache-Control": "public, max-age=86400"}
+    
+    if etag in (e.strip() for e in request.headers.get("if-none-match", "").split(",")):
+        return Response(status_code=304, headers=cabeceras)
     
-    return StreamingResponse(
-        output,
+    return Response(
+        content=contenido,
         media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        headers={'Content-Disposition': 'attachment; filename=template_clientes.xlsx'}
+        headers={'Content-Disposition': 'attachment; filename=template_clientes.xlsx', **cabeceras}
     )
 
 
 @router.post("/clientes/importar")
-async def importar_clientes_excel(
+def importar_clientes_excel(
     archivo: UploadFile = File(...),
     emisor_ruc: str = Form(...),
     db: Session = Depends(get_db)
@@ -434,16 +529,17 @@ async def importar_clientes_excel(
     """Importar clientes desde archivo Excel o CSV"""
     
     # Buscar emisor
-    emisor = db.query(Emisor).filter(Emisor.ruc == emisor_ruc).first()
+    emisor = emisor_sesion_por_ruc(db, emisor_ruc)
     if not emisor:
         raise HTTPException(status_code=404, detail="Emisor no encontrado")
     
     try:
-        # Leer archivo según extensión
+        # Leer archivo según extensión. Todo como texto: un documento numérico no
+        # pierde ceros a la izquierda ni termina en '.0'.
         if archivo.filename.endswith('.csv'):
-            df = pd.read_csv(archivo.file)
+            df = pd.read_csv(archivo.file, dtype=str)
         elif archivo.filename.endswith(('.xlsx', '.xls')):
-            df = pd.read_excel(archivo.file)
+            df = pd.read_excel(archivo.file, dtype=str, engine=EXCEL_ENGINE)
         else:
             return {
                 "exito": False,
@@ -460,47 +556,63 @@ async def importar_clientes_excel(
                 "error": f"Faltan columnas requeridas: {', '.join(missing_cols)}"
             }
         
-        importados = 0
-        actualizados = 0
-        errores = []
+        # Normalización vectorizada (columnas enteras, sin iterrows): vacíos como '',
+        # columnas opcionales ausentes con su valor por defecto.
+        df = df.fillna('')
+        for col in ('tipo_documento', 'direccion', 'email', 'telefono'):
+            if col not in df.columns:
+                df[col] = ''
+        df['numero_documento'] = df['numero_documento'].str.strip()
+        df['tipo_documento'] = df['tipo_documento'].str.strip().replace('', '6')
         
-        for idx, row in df.iterrows():
-            try:
-                # Validar número de documento
-                numero_doc = str(row['numero_documento']).strip()
-                if not numero_doc or numero_doc == 'nan':
-                    errores.append(f"Fila {idx+2}: Número de documento vacío")
-                    continue
-                
-                # Verificar si ya existe
-                cliente_existe = db.query(Cliente).filter(
-                    Cliente.emisor_id == emisor.id,
-                    Cliente.numero_documento == numero_doc
-                ).first()
-                
-                if cliente_existe:
-                    # Actualizar cliente existente
-                    cliente_existe.razon_social = str(row['razon_social'])
-                    cliente_existe.direccion = str(row.get('direccion', ''))
-                    cliente_existe.email = str(row.get('email', ''))
-                    cliente_existe.telefono = str(row.get('telefono', ''))
-                    actualizados += 1
-                else:
-                    # Crear nuevo cliente
-                    cliente = Cliente(
-                        emisor_id=emisor.id,
-                        tipo_documento=str(row.get('tipo_documento', '6')),
-                        numero_documento=numero_doc,
-                        razon_social=str(row['razon_social']),
-                        direccion=str(row.get('direccion', '')),
-                        email=str(row.get('email', '')),
-                        telefono=str(row.get('telefono', ''))
-                    )
-                    db.add(cliente)
-                    importados += 1
-                
-            except Exception as e:
-                errores.append(f"Fila {idx+2}: {str(e)}")
+        vacios = df['numero_documento'] == ''
+        errores = [f"Fila {idx+2}: Número de documento vacío" for idx in df.index[vacios]]
+        df = df[~vacios]
+        
+        nuevos = {}         # numero_documento -> mapping a insertar
+        cambios = {}        # numero_documento -> mapping a actualizar (con id)
+        
+        # Una sola consulta para saber qué documentos ya existen
+        documentos = set(df['numero_documento'])
+        existentes = dict(
+            db.query(Cliente.numero_documento, Cliente.id).filter(
+                Cliente.emisor_id == emisor.id,
+                Cliente.numero_documento.in_(documentos)
+            ).all()
+        ) if documentos else {}
+        
+        columnas = ['tipo_documento', 'numero_documento', 'razon_social', 'direccion', 'email', 'telefono']
+        for fila in df[columnas].to_dict('records'):
+            numero_doc = fila['numero_documento']
+            datos = {
+                "razon_social": fila['razon_social'],
+                "direccion": fila['direccion'],
+                "email": fila['email'],
+                "telefono": fila['telefono']
+            }
+            
+            if numero_doc in existentes:
+                # Actualizar cliente existente
+                cambios[numero_doc] = {"id": existentes[numero_doc], **datos}
+            elif numero_doc in nuevos:
+                # Repetido dentro del archivo: la última fila manda
+                nuevos[numero_doc].update(datos)
+            else:
+                # Crear nuevo cliente
+                nuevos[numero_doc] = {
+                    "emisor_id": emisor.id,
+                    "tipo_documento": fila['tipo_documento'],
+                    "numero_documento": numero_doc,
+                    **datos
+                }
+        
+        importados = len(nuevos)
+        actualizados = len(cambios)
+        if cambios:
+            # UPDATE por clave primaria en executemany (una sentencia, lotes del driver)
+            db.execute(update(Cliente), list(cambios.values()))
+        if nuevos:
+            db.execute(insert(Cliente), list(nuevos.values()))
         
         db.commit()
         
@@ -529,47 +641,46 @@ def obtener_progreso_reenvio(
     Retorna cuántos están procesando, cuántos terminaron, etc.
     """
     
-    emisor = db.query(Emisor).filter(Emisor.ruc == emisor_ruc).first()
+    emisor = emisor_sesion_por_ruc(db, emisor_ruc)
     if not emisor:
         raise HTTPException(status_code=404, detail="Emisor no encontrado")
     
     # Buscar comprobantes de hoy
     hoy = date.today()
     
-    # Estados
-    total_rechazados = db.query(Comprobante).filter(
-        Comprobante.emisor_id == emisor.id,
-        Comprobante.fecha_emision == hoy,
-        Comprobante.estado == 'rechazado'
-    ).count()
-    
-    procesando = db.query(Comprobante).filter(
+    # Estados: los tres contadores en una sola pasada (count FILTER)
+    conteos = db.query(
+        func.count().filter(Comprobante.estado == 'rechazado').label("rechazados"),
+        func.count().filter(Comprobante.estado == 'enviando').label("procesando"),
+        func.count().filter(and_(
+            Comprobante.estado == 'aceptado',
+            Comprobante.ultimo_intento_envio >= datetime.now() - timedelta(minutes=5)
+        )).label("aceptados"),
+    ).filter(
         Comprobante.emisor_id == emisor.id,
         Comprobante.fecha_emision == hoy,
-        Comprobante.estado == 'enviando'
-    ).count()
-    
-    aceptados_hoy = db.query(Comprobante).filter(
-        Comprobante.emisor_id == emisor.id,
-        Comprobante.fecha_emision == hoy,
-        Comprobante.estado == 'aceptado',
-        Comprobante.ultimo_intento_envio.isnot(None),
-        Comprobante.ultimo_intento_envio >= datetime.now() - timedelta(minutes=5)
-    ).count()
-    
-    # Detectar atorados (más de 30 segundos procesando)
-    atorados = db.query(Comprobante).filter(
-        Comprobante.emisor_id == emisor.id,
-        Comprobante.estado == 'enviando',
-        Comprobante.procesando_desde.isnot(None),
-        Comprobante.procesando_desde < datetime.now() - timedelta(seconds=30)
-    ).all()
-    
-    # Marcar atorados como error
-    for comp in atorados:
-        comp.estado = 'error'
-        comp.descripcion_respuesta = 'Timeout: Procesamiento demoró más de 30 segundos'
-        comp.procesando_desde = None
+        Comprobante.estado.in_(['rechazado', 'enviando', 'aceptado'])
+    ).one()
+    total_rechazados = conteos.rechazados
+    procesando = conteos.procesando
+    aceptados_hoy = conteos.aceptados
+    
+    # Marcar como error los atorados (más de 30 segundos procesando): un solo UPDATE
+    atorados = db.execute(
+        update(Comprobante)
+        .where(
+            Comprobante.emisor_id == emisor.id,
+            Comprobante.estado == 'enviando',
+            Comprobante.procesando_desde.isnot(None),
+            Comprobante.procesando_desde < datetime.now() - timedelta(seconds=30)
+        )
+        .values(
+            estado='error',
+            descripcion_respuesta='Timeout: Procesamiento demoró más de 30 segundos',
+            procesando_desde=None
+        )
+        .execution_options(synchronize_session=False)
+    ).rowcount
     
     if atorados:
         db.commit()
@@ -578,7 +689,7 @@ def obtener_progreso_reenvio(
         "procesando": procesando,
         "rechazados": total_rechazados,
         "recien_aceptados": aceptados_hoy,
-        "atorados": len(atorados),
+        "atorados": atorados,
         "total_original": procesando + total_rechazados + aceptados_hoy,
         "progreso_porcentaje": int((aceptados_hoy / (procesando + total_rechazados + aceptados_hoy)) * 100) if (procesando + total_rechazados + aceptados_hoy) > 0 else 0
     }
@@ -606,16 +717,23 @@ class EmitirComprobanteRequest(BaseModel):
     numero: Optional[int] = None
     fecha_emision: Optional[str] = None
 
+
+IGV_TASA = Decimal('0.18')
+
+
+def _centimos(monto: Decimal) -> Decimal:
+    return monto.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+
+
 @router.post("/comprobantes/emitir")
-async def emitir_comprobante(
+def emitir_comprobante(
     request: FastAPIRequest,
+    data: dict = Body(...),
     db: Session = Depends(get_db)
 ):
     """Emitir nuevo comprobante electrónico"""
-    from uuid import uuid4
     
-    # Recibir JSON directamente (sin Pydantic)
-    data = await request.json()
+    # JSON recibido como dict (sin Pydantic)
 
     # DEBUG: Ver qué datos llegan
     print(f"DEBUG EMITIR - Data recibida: {data}")
@@ -640,52 +758,30 @@ async def emitir_comprobante(
     if not items:
         raise HTTPException(status_code=400, detail="Debe incluir al menos un item")
     
-    emisor = await obtener_emisor_actual(request, db)
+    emisor = obtener_emisor_sesion(request, db)
 
     if not emisor:
         raise HTTPException(status_code=404, detail="No hay emisor configurado")
     
-    # Obtener siguiente número (máximo actual + 1)
-    from sqlalchemy import func
-    
-    max_numero = db.query(func.max(Comprobante.numero)).filter(
-        Comprobante.emisor_id == emisor.id,
-        Comprobante.serie == serie,
-        Comprobante.tipo_documento == tipo_documento
-    ).scalar()
-    
-    siguiente_numero = (max_numero + 1) if max_numero else 1
-
-    # Verificar que no exista (prevenir duplicados por concurrencia)
-    existe = db.query(Comprobante).filter(
-        Comprobante.emisor_id == emisor.id,
-        Comprobante.serie == serie,
-        Comprobante.tipo_documento == tipo_documento,
-        Comprobante.numero == siguiente_numero
-    ).first()
-
-    if existe:
-        # Si existe, buscar el siguiente disponible
-        max_real = db.query(func.max(Comprobante.numero)).filter(
-            Comprobante.emisor_id == emisor.id,
-            Comprobante.serie == serie,
-            Comprobante.tipo_documento == tipo_documento
-        ).scalar()
-        siguiente_numero = (max_real + 1) if max_real else 1
-        print(f"WARNING: Número duplicado detectado, usando {siguiente_numero}")
+    # Siguiente número desde la fila (emisor, serie, tipo) de correlativo: un UPDATE
+    # ... RETURNING cuyo lock serializa las emisiones de la serie hasta el commit.
+    siguiente_numero = siguiente_numero_correlativo(db, emisor.id, serie, tipo_documento)
     
     # Log para debug
-    print(f"DEBUG: Serie={serie}, Tipo={tipo_documento}, MaxActual={max_numero}, Siguiente={siguiente_numero}")
+    print(f"DEBUG: Serie={serie}, Tipo={tipo_documento}, Siguiente={siguiente_numero}")
     
-    # Calcular totales
-    # Calcular totales según tipo de afectación
-    subtotal_gravado = 0
-    subtotal_exonerado = 0
-    subtotal_inafecto = 0
+    # Una sola pasada por los items: arma las líneas de detalle y acumula los
+    # subtotales por tipo de afectación. Montos en Decimal (no float), redondeo
+    # a céntimos ROUND_HALF_UP como en xml_generator.
+    comprobante_id = str(uuid4())
+    subtotal_gravado = Decimal('0')
+    subtotal_exonerado = Decimal('0')
+    subtotal_inafecto = Decimal('0')
     
-    for item in items:
-        cantidad = float(item.get('cantidad', 0))
-        precio = float(item.get('precio_unitario', 0))
+    lineas = []
+    for i, item in enumerate(items, 1):
+        cantidad = Decimal(str(item.get('cantidad', 1)))
+        precio = Decimal(str(item.get('precio_unitario', 0)))
         tipo_igv = item.get('tipo_afectacion_igv', '10')
         monto = cantidad * precio
 
@@ -697,17 +793,33 @@ async def emitir_comprobante(
             subtotal_exonerado += monto
         else:  # Inafecto
             subtotal_inafecto += monto
-    
-    subtotal = subtotal_gravado  # Base imponible solo gravado
-    igv = round(subtotal_gravado * 0.18, 2)
-    total = round(subtotal_gravado + igv + subtotal_exonerado + subtotal_inafecto, 2)
+        
+        lineas.append({
+            "id": str(uuid4()),
+            "comprobante_id": comprobante_id,
+            "orden": i,
+            # codigo del catálogo si el item lo trae (autocomplete); si no, NULL
+            # (texto libre, no descuenta stock) → comportamiento actual intacto.
+            "codigo": item.get('codigo') or None,
+            "descripcion": item.get('descripcion', ''),
+            "cantidad": cantidad,
+            "unidad": item.get('unidad_medida', 'NIU'),
+            "precio_unitario": precio,
+            "monto_linea": _centimos(monto),
+            "tipo_afectacion_igv": tipo_igv,  # ← Del formulario
+            "es_bonificacion": False,
+        })
+    
+    subtotal = _centimos(subtotal_gravado)  # Base imponible solo gravado
+    igv = _centimos(subtotal_gravado * IGV_TASA)
+    total = _centimos(subtotal_gravado + igv + subtotal_exonerado + subtotal_inafecto)
     
     peru_tz = timezone(timedelta(hours=-5))
     fecha_peru = datetime.now(peru_tz).replace(tzinfo=None)
 
     # Crear comprobante
     comprobante = Comprobante(
-        id=str(uuid4()),
+        id=comprobante_id,
         emisor_id=emisor.id,
         tipo_documento=tipo_documento,
         serie=serie,
@@ -732,43 +844,30 @@ async def emitir_comprobante(
     
     db.add(comprobante)
     
-    # Crear líneas de detalle
-    for i, item in enumerate(items, 1):
-        cantidad = float(item.get('cantidad', 1))
-        precio = float(item.get('precio_unitario', 0))
-        monto_linea = round(cantidad * precio, 2)
-        
-        linea = LineaDetalle(
-            id=str(uuid4()),
-            comprobante_id=comprobante.id,
-            orden=i,
-            # codigo del catálogo si el item lo trae (autocomplete); si no, NULL
-            # (texto libre, no descuenta stock) → comportamiento actual intacto.
-            codigo=(item.get('codigo') or None),
-            descripcion=item.get('descripcion', ''),
-            cantidad=cantidad,
-            unidad=item.get('unidad_medida', 'NIU'),
-            precio_unitario=precio,
-            monto_linea=monto_linea,
-            tipo_afectacion_igv=item.get('tipo_afectacion_igv', '10'),  # ← Del formulario
-            es_bonificacion=False
-        )
-        db.add(linea)
+    # Líneas de detalle: un solo INSERT multi-fila (sin un objeto ORM por línea).
+    # El flush escribe antes el comprobante (FK de linea_detalle); un único commit.
+    db.flush()
+    db.execute(insert(LineaDetalle), lineas)
     
     db.commit()
     
+    # Orden del autocomplete: +1 a veces_usado de los productos del catálogo (no-fatal)
+    try:
+        incrementar_uso(db, emisor.id, (item.get('codigo') for item in items))
+    except Exception as _e:
+        db.rollback()
+        print(f"[PRODUCTO] Incremento de veces_usado falló: {_e}")
+    
     # Encolar envío a SUNAT automáticamente
     # Encolar envío a SUNAT automáticamente
     try:
         if CELERY_DISPONIBLE:
-            from src.tasks.celery_app import celery_app
             celery_app.send_task('enviar_comprobante_sunat', args=[comprobante.id])
             comprobante.estado = 'enviando'
             db.commit()
             print(f"DEBUG: Tarea enviar_comprobante_sunat encolada para {comprobante.id}")
         else:
             # Envío síncrono si no hay Celery
-            from src.services.sunat_service import SunatService
             sunat_service = SunatService(db)
             resultado = sunat_service.enviar_comprobante(comprobante.id)
             if resultado.get('exito'):
@@ -780,7 +879,6 @@ async def emitir_comprobante(
             # Hook no-fatal: descontar stock al quedar aceptada.
             if comprobante.estado == 'aceptado':
                 try:
-                    from src.services.stock_service import descontar_por_comprobante
                     descontar_por_comprobante(db, comprobante.id)
                 except Exception as _e:
                     try:
@@ -822,32 +920,24 @@ def api_consultar_dni(numero: str):
 
 
 
-@router.post("/configuracion/certificado")
-async def subir_certificado(
-    request: FastAPIRequest,
-    db: Session = Depends(get_db)
-):
-    """Sube y valida un certificado digital"""
-    from uuid import uuid4
-    import io
-    
-    # Obtener datos del form
-    form = await request.form()
-    archivo = form.get("archivo")
-    password = form.get("password")
-    
-    if not archivo or not password:
-        raise HTTPException(status_code=400, detail="Archivo y contraseña son requeridos")
-    
-    # Obtener emisor de la sesión
-    emisor = await obtener_emisor_actual(request, db)
-    
-    # Leer archivo
-    contenido = await archivo.read()
-    
+@lru_cache(maxsize=1)
+def _fernet() -> Fernet:
+    """Fernet de settings.encryption_key, construido una sola vez por proceso.
+    Perezoso: una clave inválida falla al cifrar, no al importar el módulo."""
+    key = settings.encryption_key.encode()
+    # Asegurar que sea base64 válido de 32 bytes
+    if len(key) < 32:
+        key = base64.urlsafe_b64encode(key.ljust(32)[:32])
+    return Fernet(key)
+
+
+def _procesar_pfx(contenido: bytes, password: str) -> tuple:
+    """Valida el .pfx (PKCS12, vigencia) y cifra contenido y contraseña con Fernet.
+    Es CPU puro: subir_certificado lo corre en el threadpool para no frenar el
+    event loop. Devuelve (pfx_encriptado, password_encriptado, serial_number,
+    fecha_vencimiento)."""
     # Validar certificado
     try:
-        from cryptography.hazmat.primitives.serialization import pkcs12
         
         # Intentar cargar el .pfx con la contraseña
         private_key, certificate, additional_certs = pkcs12.load_key_and_certificates(
@@ -864,7 +954,6 @@ async def subir_certificado(
         serial_number = str(certificate.serial_number)
         
         # Verificar que no esté vencido
-        from datetime import date
         if fecha_vencimiento < date.today():
             raise HTTPException(
                 status_code=400, 
@@ -877,17 +966,35 @@ async def subir_certificado(
         raise HTTPException(status_code=400, detail=f"Error al leer certificado: Contraseña incorrecta o archivo inválido")
     
     # Encriptar contenido y contraseña
-    from src.core.config import settings
+    fernet = _fernet()
+    return (
+        fernet.encrypt(contenido),
+        fernet.encrypt(password.encode()),
+        serial_number,
+        fecha_vencimiento,
+    )
+
+
+@router.post("/configuracion/certificado")
+def subir_certificado(
+    request: FastAPIRequest,
+    archivo: Optional[UploadFile] = File(None),
+    password: Optional[str] = Form(None),
+    db: Session = Depends(get_db)
+):
+    """Sube y valida un certificado digital"""
+    if not archivo or not password:
+        raise HTTPException(status_code=400, detail="Archivo y contraseña son requeridos")
     
-    # Crear clave Fernet desde encryption_key
-    key = settings.encryption_key.encode()
-    # Asegurar que sea base64 válido de 32 bytes
-    if len(key) < 32:
-        key = base64.urlsafe_b64encode(key.ljust(32)[:32])
-    fernet = Fernet(key)
+    # Obtener emisor de la sesión
+    emisor = obtener_emisor_sesion(request, db)
+    
+    # Leer archivo (ya en el threadpool: lectura, PKCS12 y Fernet no tocan el event loop)
+    contenido = archivo.file.read()
     
-    pfx_encriptado = fernet.encrypt(contenido)
-    password_encriptado = fernet.encrypt(password.encode())
+    pfx_encriptado, password_encriptado, serial_number, fecha_vencimiento = (
+        _procesar_pfx(contenido, password)
+    )
     
     # Desactivar certificados anteriores
     db.query(Certificado).filter(
@@ -924,26 +1031,20 @@ async def subir_certificado(
 
 
 @router.post("/configuracion/credenciales-sol")
-async def guardar_credenciales_sol(
+def guardar_credenciales_sol(
     request: FastAPIRequest,
+    data: dict = Body(...),
     db: Session = Depends(get_db)
 ):
     """Guarda las credenciales SOL"""
-    data = await request.json()
-    
-    emisor = await obtener_emisor_actual(request, db)
+    emisor = obtener_emisor_sesion(request, db)
     
     # Actualizar credenciales
     emisor.sol_usuario = data.get('usuario_sol')
     
     if data.get('clave_sol'):
         # Encriptar clave SOL
-        from src.core.config import settings
-        key = settings.encryption_key.encode()
-        if len(key) < 32:
-            key = base64.urlsafe_b64encode(key.ljust(32)[:32])
-        fernet = Fernet(key)
-        emisor.sol_password = fernet.encrypt(data['clave_sol'].encode()).decode()
+        emisor.sol_password = _fernet().encrypt(data['clave_sol'].encode()).decode()
     
     db.commit()
 
@@ -1028,14 +1129,13 @@ def get_comprobante_detalle(comprobante_id: str, db: Session = Depends(get_db)):
 
 
 @router.post("/configuracion/formato")
-async def guardar_formato(
+def guardar_formato(
     request: FastAPIRequest,
+    data: dict = Body(...),
     db: Session = Depends(get_db)
 ):
     """Guarda los formatos de impresión por tipo de documento"""
-    data = await request.json()
-    
-    emisor = await obtener_emisor_actual(request, db)
+    emisor = obtener_emisor_sesion(request, db)
     
     formatos_validos = ['A4', 'A5', 'TICKET']
     
@@ -1060,17 +1160,14 @@ async def guardar_formato(
     }
 
 @router.post("/comprobantes/nota-credito")
-async def emitir_nota_credito(
+def emitir_nota_credito(
     request: FastAPIRequest,
+    data: dict = Body(...),
     db: Session = Depends(get_db)
 ):
     """Emite una Nota de Crédito"""
-    from uuid import uuid4
-    from datetime import datetime, timedelta, timezone
     
-    data = await request.json()
-    
-    emisor = await obtener_emisor_actual(request, db)
+    emisor = obtener_emisor_sesion(request, db)
     
     # Validar comprobante de referencia
     comprobante_ref_id = data.get('comprobante_ref_id')
@@ -1089,14 +1186,8 @@ async def emitir_nota_credito(
     serie = data.get('serie', 'FC01')
     tipo_documento = '07'  # Nota de Crédito
     
-    # Obtener siguiente número
-    from sqlalchemy import func
-    max_numero = db.query(func.max(Comprobante.numero)).filter(
-        Comprobante.emisor_id == emisor.id,
-        Comprobante.serie == serie,
-        Comprobante.tipo_documento == tipo_documento
-    ).scalar()
-    siguiente_numero = (max_numero + 1) if max_numero else 1
+    # Obtener siguiente número (correlativo de la serie, ver correlativo_service)
+    siguiente_numero = siguiente_numero_correlativo(db, emisor.id, serie, tipo_documento)
     
     # Validar items
     items = data.get('items', [])
@@ -1169,7 +1260,6 @@ async def emitir_nota_credito(
     # Encolar envío a SUNAT
     try:
         if CELERY_DISPONIBLE:
-            from src.tasks.celery_app import celery_app
             celery_app.send_task('enviar_comprobante_sunat', args=[nc.id])
             nc.estado = 'enviando'
             db.commit()
@@ -1192,15 +1282,13 @@ async def emitir_nota_credito(
 # =============================================
 
 @router.post("/configuracion/logo", summary="Subir logo del emisor")
-async def subir_logo(
+def subir_logo(
     request: Request,
     logo: UploadFile = File(...),
     db: Session = Depends(get_db)
 ):
     """Sube el logo del emisor (PNG, JPG, max 500KB)"""
-    from src.api.auth_utils import obtener_emisor_actual
-
-    emisor = await obtener_emisor_actual(request, db)
+    emisor = obtener_emisor_sesion(request, db)
 
     # Validar tipo
     allowed_types = ["image/png", "image/jpeg", "image/jpg", "image/webp"]
@@ -1208,7 +1296,7 @@ async def subir_logo(
         raise HTTPException(400, detail="Solo se permiten imágenes PNG, JPG o WebP")
 
     # Leer bytes
-    logo_bytes = await logo.read()
+    logo_bytes = logo.file.read()
 
     # Validar tamaño (500KB max)
     if len(logo_bytes) > 512_000:
@@ -1227,14 +1315,12 @@ async def subir_logo(
 # =============================================
 
 @router.get("/configuracion/logo", summary="Obtener logo del emisor")
-async def obtener_logo(
+def obtener_logo(
     request: Request,
     db: Session = Depends(get_db)
 ):
     """Retorna la imagen del logo"""
-    from src.api.auth_utils import obtener_emisor_actual
-
-    emisor = await obtener_emisor_actual(request, db)
+    emisor = obtener_emisor_sesion(request, db)
 
     if not emisor.logo:
         raise HTTPException(404, detail="No hay logo configurado")
@@ -1255,7 +1341,7 @@ async def obtener_logo(
     "/emisor/{emisor_id}/logo",
     summary="Logo del emisor (público para PDFs)"
 )
-async def logo_emisor_publico(
+def logo_emisor_publico(
     emisor_id: str,
     db: Session = Depends(get_db)
 ):
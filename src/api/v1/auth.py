@@ -4,6 +4,7 @@ Autenticación API v1
 from fastapi import Header, HTTPException, Depends, Request
 from sqlalchemy.orm import Session
 import hashlib
+import hmac
 from datetime import date
 
 from src.api.dependencies import get_db
@@ -41,9 +42,10 @@ async def verificar_api_key(
     if not emisor:
         raise APIAuthError("INVALID_API_KEY", "API Key inválida")
     
-    # Verificar API Secret (comparar hash)
+    # Verificar API Secret: SHA-256 simple (el secret ya es aleatorio de 256 bits,
+    # no hace falta un KDF lento) y comparación en tiempo constante
     secret_hash = hashlib.sha256(x_api_secret.encode()).hexdigest()
-    if emisor.api_secret != secret_hash:
+    if not hmac.compare_digest(secret_hash, emisor.api_secret or ""):
         raise APIAuthError("INVALID_API_SECRET", "API Secret inválido")
     
     # Verificar que API esté activa
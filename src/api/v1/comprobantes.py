@@ -3,6 +3,7 @@ API v1 - Endpoints de Comprobantes
 """
 from fastapi import APIRouter, Depends, HTTPException, Request
 from fastapi.responses import Response
+from sqlalchemy import insert
 from sqlalchemy.orm import Session
 from uuid import uuid4
 from datetime import timezone, timedelta, datetime, date, time as dt_time
@@ -21,6 +22,7 @@ from src.api.v1.schemas import (
 from pydantic import BaseModel
 from typing import Optional
 from src.api.v1.pdf_generator import generar_pdf_comprobante
+from src.services.correlativo_service import siguiente_numero
 
 PERU_TZ = timedelta(hours=-5)
 
@@ -151,14 +153,8 @@ async def emitir_comprobante(
                 serie = "B001"
         
         # === OBTENER CORRELATIVO ===
-        db.expire_all()
-        
-        ultimo = db.query(Comprobante).filter(
-            Comprobante.emisor_id == emisor.id,
-            Comprobante.serie == serie
-        ).order_by(Comprobante.numero.desc()).first()
-        
-        numero = (ultimo.numero + 1) if ultimo else 1
+        # Fila (emisor, serie, tipo) de correlativo, bloqueada hasta el commit
+        numero = siguiente_numero(db, emisor.id, serie, data.tipo_comprobante)
         
         # === CALCULAR TOTALES ===
         subtotal = 0
@@ -278,26 +274,29 @@ async def emitir_comprobante(
         db.add(comprobante)
         
         # === CREAR ITEMS ===
-        for i, item_data in enumerate(items_data, 1):
-            item = LineaDetalle(
-                id=str(uuid4()),
-                comprobante_id=comprobante_id,
-                orden=i,
+        # Un solo INSERT multi-fila; el flush escribe antes cliente y comprobante (FK).
+        db.flush()
+        db.execute(insert(LineaDetalle), [
+            {
+                "id": str(uuid4()),
+                "comprobante_id": comprobante_id,
+                "orden": i,
                 # codigo_interno del catálogo si vino explícito (habilita descuento
                 # de stock); si no, el secuencial actual (compatibilidad QueVendi/API).
-                codigo=item_data.get("codigo") or f"ITEM{i:03d}",
-                descripcion=item_data["descripcion"],
-                cantidad=item_data["cantidad"],
-                unidad=item_data["unidad_medida"],
-                precio_unitario=item_data["precio_unitario"],
-                valor_unitario=item_data["valor_unitario"],
-                descuento=item_data["descuento"],
-                subtotal=item_data["subtotal"],
-                igv=item_data["igv"],
-                monto_linea=item_data["total"],
-                tipo_afectacion_igv=item_data["tipo_afectacion_igv"]
-            )
-            db.add(item)
+                "codigo": item_data.get("codigo") or f"ITEM{i:03d}",
+                "descripcion": item_data["descripcion"],
+                "cantidad": item_data["cantidad"],
+                "unidad": item_data["unidad_medida"],
+                "precio_unitario": item_data["precio_unitario"],
+                "valor_unitario": item_data["valor_unitario"],
+                "descuento": item_data["descuento"],
+                "subtotal": item_data["subtotal"],
+                "igv": item_data["igv"],
+                "monto_linea": item_data["total"],
+                "tipo_afectacion_igv": item_data["tipo_afectacion_igv"],
+            }
+            for i, item_data in enumerate(items_data, 1)
+        ])
         
         # === INCREMENTAR CONTADOR ===
         emisor.docs_mes_usados = (emisor.docs_mes_usados or 0) + 1
@@ -448,14 +447,16 @@ from src.api.v1.pdf_generator import generar_pdf_comprobante
     summary="Descargar PDF",
     description="Genera y descarga el PDF del comprobante"
 )
-async def obtener_pdf(
+def obtener_pdf(
     comprobante_id: str,
     formato: str = "A4",
     codigo_matricula: str = None,
     emisor: Emisor = Depends(verificar_api_key),
     db: Session = Depends(get_db)
 ):
-    """Genera y retorna el PDF del comprobante"""
+    """Genera y retorna el PDF del comprobante.
+    `def` (no async): consultas y render con reportlab son bloqueantes; FastAPI lo
+    corre en el threadpool y el event loop sigue atendiendo otros requests."""
     comprobante = db.query(Comprobante).filter(
         Comprobante.id == comprobante_id,
         Comprobante.emisor_id == emisor.id
@@ -55,11 +55,12 @@ async def verificar_comprobante(
 
 
 @router.get("/{comprobante_id}/pdf")
-async def verificar_pdf(
+def verificar_pdf(
     comprobante_id: str,
     db: Session = Depends(get_db)
 ):
-    """PDF público para verificación (sin auth)"""
+    """PDF público para verificación (sin auth). `def`: el render del PDF es CPU
+    bloqueante y corre en el threadpool, fuera del event loop."""
     from fastapi.responses import Response
     from src.models.models import Comprobante, Emisor, Cliente, LineaDetalle
     from src.api.v1.pdf_generator import generar_pdf_comprobante
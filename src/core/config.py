@@ -13,6 +13,24 @@ class Settings(BaseSettings):
     debug: bool = Field(True, env='DEBUG')
     log_level: str = Field('INFO', env='LOG_LEVEL')
     environment: str = Field('development', env='ENVIRONMENT')
+    # Pool de conexiones (por proceso). Con N workers de uvicorn/celery el total es
+    # N * (db_pool_size + db_max_overflow): debe quedar por debajo de max_connections
+    # de Postgres. Con varios workers, mejor PgBouncer (modo transaction, :6432).
+    db_pool_size: int = Field(20, env='DB_POOL_SIZE')
+    db_max_overflow: int = Field(20, env='DB_MAX_OVERFLOW')
+    db_pool_timeout: int = Field(30, env='DB_POOL_TIMEOUT')
+    db_pool_recycle: int = Field(1800, env='DB_POOL_RECYCLE')
+    db_statement_timeout_ms: int = Field(30000, env='DB_STATEMENT_TIMEOUT_MS')
+    # true detrás de PgBouncer (transaction mode): sin pool propio (NullPool), sin el
+    # parámetro de arranque `options` y sin sesiones read-only (ver dependencies.py).
+    # DB_STATEMENT_TIMEOUT_MS no aplica: fijar el timeout en el rol de Postgres.
+    db_null_pool: bool = Field(False, env='DB_NULL_POOL')
+    # Cache LRU de SQL compilado por engine (default de SQLAlchemy: 500 sentencias)
+    db_query_cache_size: int = Field(1200, env='DB_QUERY_CACHE_SIZE')
+    # Solo con driver psycopg 3 (DATABASE_URL postgresql+psycopg://): tras N ejecuciones
+    # de la misma sentencia el driver la prepara en el servidor (sin parse/plan por
+    # llamada). None = desactivado; detrás de PgBouncer < 1.21 en modo transaction, dejar None.
+    db_prepare_threshold: int | None = Field(None, env='DB_PREPARE_THRESHOLD')
     # Busca la clase Settings y AGREGA este campo:
     APIS_NET_PE_TOKEN: str = Field("", env="APIS_NET_PE_TOKEN")
     # Cache-busting de estáticos propios: bumpea este valor (o la env APP_VERSION)
@@ -1,4 +1,5 @@
 from fastapi import FastAPI
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
 from pathlib import Path
@@ -28,6 +29,10 @@ app = FastAPI(
     description='Sistema de Facturación Electrónica SUNAT'
 )
 
+# Listados JSON/HTML (clientes, productos, comprobantes) comprimen 5-10x;
+# respuestas menores a 1 KB no valen el costo de gzip.
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=6)
+
 # Crear tablas si no existen
 try:
     Base.metadata.create_all(bind=engine)
@@ -3,12 +3,18 @@ from uuid import uuid4
 from datetime import datetime, timezone, date, timedelta
 from decimal import Decimal
 from sqlalchemy import (
-    Column, String, Integer, Boolean, Date, DateTime, Text, Numeric, LargeBinary, JSON, ForeignKey, Index
+    Column, String, Integer, Boolean, Date, DateTime, Text, Numeric, LargeBinary, JSON, ForeignKey, Index,
+    DDL, event, Computed, func, text
 )
-from sqlalchemy.orm import relationship, declarative_base
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import relationship, declarative_base, deferred
 
 Base = declarative_base()
 
+# Los índices gin_trgm_ops (búsquedas ILIKE '%q%') necesitan la extensión pg_trgm
+# antes de crear las tablas. En BD existentes: src/scripts/indices_rendimiento.py
+event.listen(Base.metadata, 'before_create', DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+
 def gen_uuid():
     return str(uuid.uuid4())
 
@@ -73,6 +79,13 @@ class Emisor(Base):
     activo = Column(Boolean, default=True)
 
     certificados = relationship('Certificado', back_populates='emisor', cascade='all, delete-orphan')
+    # Solo lectura: el certificado vigente, para cargarlo con joinedload en una consulta
+    certificado_activo = relationship(
+        'Certificado',
+        primaryjoin="and_(Certificado.emisor_id == Emisor.id, Certificado.activo == True)",
+        uselist=False,
+        viewonly=True,
+    )
     comprobantes = relationship('Comprobante', back_populates='emisor', cascade='all, delete-orphan')
     clientes = relationship('Cliente', back_populates='emisor', cascade='all, delete-orphan')
     productos = relationship('Producto', back_populates='emisor', cascade='all, delete-orphan')
@@ -84,6 +97,11 @@ class Emisor(Base):
     logo = Column(LargeBinary, nullable=True)
     logo_content_type = Column(String(50), nullable=True)
 
+    __table_args__ = (
+        # Login/registro buscan por email sin distinguir mayúsculas: lower(email) = ...
+        Index('idx_emisor_email_lower', func.lower(email)),
+    )
+
 class Certificado(Base):
     __tablename__ = 'certificado'
 
@@ -150,6 +168,124 @@ class Comprobante(Base):
     respuesta = relationship('RespuestaSunat', uselist=False, back_populates='comprobante', cascade='all, delete-orphan')
     cliente = relationship("Cliente", back_populates="comprobantes")
 
+    __table_args__ = (
+        # Listado del dashboard: WHERE emisor_id ORDER BY fecha_emision DESC, numero DESC
+        Index('idx_comprobante_emisor_fecha_num', emisor_id, fecha_emision.desc(), numero.desc()),
+        # Contadores de pendientes/encolados/rechazados: parcial, solo las filas "vivas"
+        Index('idx_comprobante_emisor_estado_vivo', 'emisor_id', 'estado',
+              postgresql_where=estado.in_(['pendiente', 'enviando', 'encolado', 'rechazado'])),
+        # Filtro por tipo de documento (listado, series) dentro del rango de fechas
+        Index('idx_comprobante_emisor_tipo', 'emisor_id', 'tipo_documento', 'fecha_emision'),
+        # Único: respaldo de la numeración por correlativo (correlativo_service)
+        Index('uq_comprobante_emisor_tipo_serie_numero', 'emisor_id', 'tipo_documento', 'serie', 'numero',
+              unique=True),
+        # Estadísticas del dashboard en una pasada: index-only scan (monto_total en INCLUDE)
+        Index('idx_comprobante_emisor_stats', 'emisor_id', 'fecha_emision', 'estado', 'tipo_documento',
+              postgresql_include=['monto_total']),
+        # Búsqueda ILIKE '%q%' por serie / número formateado
+        Index('idx_comprobante_serie_trgm', 'serie',
+              postgresql_using='gin', postgresql_ops={'serie': 'gin_trgm_ops'}),
+        Index('idx_comprobante_numero_formato_trgm', 'numero_formato',
+              postgresql_using='gin', postgresql_ops={'numero_formato': 'gin_trgm_ops'}),
+    )
+
+class ComprobanteResumenDiario(Base):
+    """Totales por (emisor, día, estado, tipo) que mantienen los triggers
+    trg_comprobante_resumen_diario_*: el dashboard suma unas decenas de filas en vez
+    de recorrer todos los comprobantes del emisor.
+    Poblar en BD existentes: src/scripts/resumen_diario.py"""
+    __tablename__ = 'comprobante_resumen_diario'
+
+    emisor_id = Column(String(36), ForeignKey('emisor.id'), primary_key=True)
+    fecha = Column(Date, primary_key=True)
+    estado = Column(String(32), primary_key=True)       # '' si comprobante.estado es NULL
+    tipo_documento = Column(String(2), primary_key=True)
+    cantidad = Column(Integer, nullable=False, default=0)
+    monto_total = Column(Numeric(16,2), nullable=False, default=Decimal('0.00'))
+
+class Correlativo(Base):
+    """Último número emitido por (emisor, serie, tipo). Toda emisión lo incrementa
+    con UPDATE ... RETURNING (src/services/correlativo_service.py) y el lock de la
+    fila serializa las emisiones concurrentes de una misma serie.
+    Sembrar en BD existentes: src/scripts/correlativos.py"""
+    __tablename__ = 'correlativo'
+
+    emisor_id = Column(String(36), ForeignKey('emisor.id'), primary_key=True)
+    serie = Column(String(4), primary_key=True)
+    tipo_documento = Column(String(2), primary_key=True)
+    ultimo_numero = Column(Integer, nullable=False, default=0)
+
+# Triggers que mantienen comprobante_resumen_diario. Son por sentencia (FOR EACH
+# STATEMENT) con tablas de transición: cada INSERT/UPDATE/DELETE, aunque toque miles
+# de comprobantes (reenvío por lotes), suma sus deltas agrupados por clave y hace un
+# solo upsert, en orden fijo de clave. Dos sentencias que mueven filas entre los
+# mismos estados en sentido contrario (rechazado -> enviando del reenvío, enviando ->
+# rechazado de los workers) bloquean las filas del resumen en el mismo orden y no
+# se interbloquean. Las claves cuyo delta neto es cero (UPDATE que no cambia
+# emisor, fecha, estado, tipo ni monto) no se tocan.
+_RESUMEN_DIARIO_UPSERT = """
+        INSERT INTO comprobante_resumen_diario AS r
+               (emisor_id, fecha, estado, tipo_documento, cantidad, monto_total)
+        SELECT emisor_id, fecha_emision, coalesce(estado, ''), tipo_documento,
+               sum(n), sum(monto)
+          FROM ({delta}) d
+         GROUP BY 1, 2, 3, 4
+        HAVING sum(n) <> 0 OR sum(monto) <> 0
+         ORDER BY 1, 2, 3, 4
+        ON CONFLICT (emisor_id, fecha, estado, tipo_documento) DO UPDATE
+           SET cantidad = r.cantidad + EXCLUDED.cantidad,
+               monto_total = r.monto_total + EXCLUDED.monto_total;"""
+_RESUMEN_DIARIO_NUEVAS = (
+    "SELECT emisor_id, fecha_emision, estado, tipo_documento, 1 AS n, "
+    "coalesce(monto_total, 0) AS monto FROM nuevas"
+)
+_RESUMEN_DIARIO_VIEJAS = (
+    "SELECT emisor_id, fecha_emision, estado, tipo_documento, -1 AS n, "
+    "-coalesce(monto_total, 0) AS monto FROM viejas"
+)
+RESUMEN_DIARIO_FUNCION = DDL("""
+CREATE OR REPLACE FUNCTION comprobante_resumen_diario_trg() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN""" + _RESUMEN_DIARIO_UPSERT.format(delta=_RESUMEN_DIARIO_NUEVAS) + """
+    ELSIF TG_OP = 'DELETE' THEN""" + _RESUMEN_DIARIO_UPSERT.format(delta=_RESUMEN_DIARIO_VIEJAS) + """
+    ELSE""" + _RESUMEN_DIARIO_UPSERT.format(
+        delta=_RESUMEN_DIARIO_NUEVAS + " UNION ALL " + _RESUMEN_DIARIO_VIEJAS) + """
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql
+""")
+# Una tabla de transición exige un trigger por evento. El trigger por fila anterior
+# (trg_comprobante_resumen_diario) se reemplaza en la misma transacción.
+RESUMEN_DIARIO_TRIGGER = DDL("""
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'trg_comprobante_resumen_diario') THEN
+        DROP TRIGGER trg_comprobante_resumen_diario ON comprobante;
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'trg_comprobante_resumen_diario_ins') THEN
+        CREATE TRIGGER trg_comprobante_resumen_diario_ins
+        AFTER INSERT ON comprobante REFERENCING NEW TABLE AS nuevas
+        FOR EACH STATEMENT EXECUTE FUNCTION comprobante_resumen_diario_trg();
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'trg_comprobante_resumen_diario_upd') THEN
+        CREATE TRIGGER trg_comprobante_resumen_diario_upd
+        AFTER UPDATE ON comprobante REFERENCING OLD TABLE AS viejas NEW TABLE AS nuevas
+        FOR EACH STATEMENT EXECUTE FUNCTION comprobante_resumen_diario_trg();
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'trg_comprobante_resumen_diario_del') THEN
+        CREATE TRIGGER trg_comprobante_resumen_diario_del
+        AFTER DELETE ON comprobante REFERENCING OLD TABLE AS viejas
+        FOR EACH STATEMENT EXECUTE FUNCTION comprobante_resumen_diario_trg();
+    END IF;
+END
+$$
+""")
+# after_create de la metadata: corre en cada create_all, ya con ambas tablas creadas
+# (el DDL es idempotente).
+event.listen(Base.metadata, 'after_create', RESUMEN_DIARIO_FUNCION)
+event.listen(Base.metadata, 'after_create', RESUMEN_DIARIO_TRIGGER)
+
 class LineaDetalle(Base):
     __tablename__ = 'linea_detalle'
 
@@ -249,6 +385,12 @@ class Cliente(Base):
     activo = Column(Boolean, default=True)
     creado_en = Column(DateTime, default=utc_now)
     actualizado_en = Column(DateTime, default=utc_now, onupdate=utc_now)
+
+    # Búsqueda full-text (columna generada por Postgres; diferida: solo se usa en filtros)
+    search_tsv = deferred(Column(TSVECTOR, Computed(
+        "to_tsvector('simple', coalesce(razon_social, '') || ' ' || coalesce(numero_documento, ''))",
+        persisted=True,
+    )))
     
     # Relaciones
     emisor = relationship("Emisor", back_populates="clientes")
@@ -256,8 +398,15 @@ class Cliente(Base):
     
     # Índices
     __table_args__ = (
-        Index('idx_cliente_emisor_documento', 'emisor_id', 'numero_documento'),
+        # Único: clave del upsert de importar_clientes (ON CONFLICT)
+        Index('uq_cliente_emisor_documento', 'emisor_id', 'numero_documento', unique=True),
         Index('idx_cliente_razon_social', 'razon_social'),
+        # Trigramas: búsqueda ILIKE '%q%' de /api/clientes sin seq scan
+        Index('idx_cliente_numdoc_trgm', 'numero_documento',
+              postgresql_using='gin', postgresql_ops={'numero_documento': 'gin_trgm_ops'}),
+        Index('idx_cliente_razon_social_trgm', 'razon_social',
+              postgresql_using='gin', postgresql_ops={'razon_social': 'gin_trgm_ops'}),
+        Index('idx_cliente_search_tsv', 'search_tsv', postgresql_using='gin'),
     )
 
 
@@ -317,9 +466,20 @@ class Producto(Base):
     
     # Índices
     __table_args__ = (
-        Index('idx_producto_emisor_codigo', 'emisor_id', 'codigo_interno'),
+        Index('uq_producto_emisor_codigo', 'emisor_id', 'codigo_interno', unique=True),  # ON CONFLICT de crear_producto
         Index('idx_producto_descripcion', 'descripcion'),
-        Index('idx_producto_favorito', 'emisor_id', 'es_favorito'),
+        # Trigramas: búsqueda ILIKE '%q%' de /api/productos sin seq scan (BitmapOr entre los tres)
+        Index('idx_producto_codigo_trgm', 'codigo_interno',
+              postgresql_using='gin', postgresql_ops={'codigo_interno': 'gin_trgm_ops'}),
+        Index('idx_producto_codigo_barras_trgm', 'codigo_barras',
+              postgresql_using='gin', postgresql_ops={'codigo_barras': 'gin_trgm_ops'}),
+        Index('idx_producto_descripcion_trgm', 'descripcion',
+              postgresql_using='gin', postgresql_ops={'descripcion': 'gin_trgm_ops'}),
+        # Categorías del emisor (DISTINCT de listar_categorias): index-only scan
+        Index('idx_producto_emisor_categoria', 'emisor_id', 'categoria',
+              postgresql_where=text("categoria IS NOT NULL AND categoria <> ''")),
+        # Listado: WHERE emisor_id AND activo ORDER BY es_favorito DESC, veces_usado DESC
+        Index('idx_producto_emisor_activo_uso', emisor_id, activo, es_favorito.desc(), veces_usado.desc()),
     )
 
 
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+correlativos.py — siembra la tabla correlativo desde la tabla comprobante.
+
+Toda emisión numera con la fila (emisor, serie, tipo) de correlativo
+(src/services/correlativo_service.py). En una BD existente hay que cargar UNA vez el
+último número de cada serie; luego la tabla se mantiene sola. Correr ANTES de
+desplegar la numeración por correlativo (crea la tabla si no existe). Es idempotente:
+nunca baja un correlativo, solo lo alinea con max(numero) si quedó atrás.
+
+Corre en una sola transacción con LOCK de comprobante en modo SHARE ROW EXCLUSIVE:
+las emisiones esperan unos segundos (no se pierden) y no pueden numerar en paralelo
+con la siembra.
+
+Ejecutar EN RAILWAY:
+  Dry-run (muestra lo que se cargaría, no escribe):  python -m src.scripts.correlativos
+  Aplicar:                                           python -m src.scripts.correlativos --send
+"""
+
+import sys
+
+from sqlalchemy import text
+
+from src.api.dependencies import engine
+from src.models.models import Correlativo
+
+AGREGADO = """
+    SELECT emisor_id, serie, tipo_documento, max(numero)
+      FROM comprobante
+     WHERE numero IS NOT NULL
+     GROUP BY 1, 2, 3
+"""
+
+
+def main():
+    send_mode = '--send' in sys.argv
+    print("=" * 72)
+    print("SIEMBRA DE CORRELATIVOS")
+    print("MODO:", "🚨 SEMBRAR" if send_mode else "🧪 DRY-RUN (sin escribir)")
+    print("=" * 72)
+
+    with engine.begin() as conn:
+        conn.execute(text("SET LOCAL statement_timeout = 0"))
+        if not send_mode:
+            filas = conn.execute(text(f"SELECT count(*) FROM ({AGREGADO}) t")).scalar()
+            print(f"  Series a sembrar: {filas}")
+            print("\n🧪 DRY-RUN: no se escribió. Para aplicar:  python -m src.scripts.correlativos --send")
+            return
+
+        Correlativo.__table__.create(conn, checkfirst=True)
+        conn.execute(text("LOCK TABLE comprobante IN SHARE ROW EXCLUSIVE MODE"))
+        resultado = conn.execute(text(
+            "INSERT INTO correlativo AS c (emisor_id, serie, tipo_documento, ultimo_numero)"
+            + AGREGADO +
+            "ON CONFLICT (emisor_id, serie, tipo_documento) DO UPDATE "
+            "SET ultimo_numero = greatest(c.ultimo_numero, EXCLUDED.ultimo_numero)"
+        ))
+        print(f"✅ {resultado.rowcount} correlativos sembrados")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+indices_rendimiento.py — crea en una BD existente los índices de rendimiento
+declarados en src/models/models.py.
+
+`Base.metadata.create_all` (src/main.py) solo crea tablas que no existen: en la BD de
+producción los índices nuevos de los modelos NO aparecen solos. Este script los crea
+con CREATE INDEX CONCURRENTLY IF NOT EXISTS (idempotente, no bloquea escrituras).
+
+Si una sentencia CONCURRENTLY falla, Postgres deja el índice como INVALID y el
+IF NOT EXISTS lo saltaría en la siguiente corrida: hacer DROP INDEX de ese índice
+antes de reintentar.
+
+Ejecutar EN RAILWAY:
+  Dry-run (lista el DDL, no escribe):   python -m src.scripts.indices_rendimiento
+  Aplicar:                              python -m src.scripts.indices_rendimiento --send
+"""
+
+import sys
+
+from sqlalchemy import text
+
+from src.api.dependencies import engine
+
+SENTENCIAS = [
+    # --- cliente: búsqueda ILIKE '%q%' de /api/clientes (listar_clientes, buscar_clientes) ---
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_cliente_numdoc_trgm "
+    "ON cliente USING gin (numero_documento gin_trgm_ops)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_cliente_razon_social_trgm "
+    "ON cliente USING gin (razon_social gin_trgm_ops)",
+    # Full-text (multi-palabra, ranking). ADD COLUMN ... STORED reescribe la tabla
+    # (lock exclusivo): correrlo en horario de baja carga.
+    "ALTER TABLE cliente ADD COLUMN IF NOT EXISTS search_tsv tsvector GENERATED ALWAYS AS "
+    "(to_tsvector('simple', coalesce(razon_social, '') || ' ' || coalesce(numero_documento, ''))) STORED",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_cliente_search_tsv "
+    "ON cliente USING gin (search_tsv)",
+    # --- cliente: clave única del upsert de importar_clientes (ON CONFLICT) ---
+    # Falla si ya hay duplicados; listarlos con:
+    #   SELECT emisor_id, numero_documento, count(*) FROM cliente
+    #   GROUP BY 1, 2 HAVING count(*) > 1;
+    "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_cliente_emisor_documento "
+    "ON cliente (emisor_id, numero_documento)",
+    "DROP INDEX CONCURRENTLY IF EXISTS idx_cliente_emisor_documento",
+    # --- comprobante: listado del dashboard (frontend.comprobantes_lista) ---
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_comprobante_emisor_fecha_num "
+    "ON comprobante (emisor_id, fecha_emision DESC, numero DESC)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_comprobante_emisor_estado_vivo "
+    "ON comprobante (emisor_id, estado) WHERE estado IN ('pendiente', 'enviando', 'encolado', 'rechazado')",
+    "DROP INDEX CONCURRENTLY IF EXISTS idx_comprobante_emisor_estado_pend",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_comprobante_emisor_tipo "
+    "ON comprobante (emisor_id, tipo_documento, fecha_emision)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_comprobante_serie_trgm "
+    "ON comprobante USING gin (serie gin_trgm_ops)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_comprobante_numero_formato_trgm "
+    "ON comprobante USING gin (numero_formato gin_trgm_ops)",
+    # --- comprobante: número único por serie (respaldo del correlativo) ---
+    # Falla si ya hay duplicados; listarlos con:
+    #   SELECT emisor_id, tipo_documento, serie, numero, count(*) FROM comprobante
+    #   GROUP BY 1, 2, 3, 4 HAVING count(*) > 1;
+    "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_comprobante_emisor_tipo_serie_numero "
+    "ON comprobante (emisor_id, tipo_documento, serie, numero)",
+    "DROP INDEX CONCURRENTLY IF EXISTS idx_comprobante_emisor_serie_numero",
+    # --- comprobante: estadísticas del dashboard (frontend.dashboard) ---
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_comprobante_emisor_stats "
+    "ON comprobante (emisor_id, fecha_emision, estado, tipo_documento) INCLUDE (monto_total)",
+    # --- emisor: login por email (registro.procesar_login, lower(email) = ...) ---
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_emisor_email_lower "
+    "ON emisor (lower(email))",
+    # --- producto: clave única del INSERT ... ON CONFLICT de crear_producto ---
+    # Falla si ya hay duplicados; listarlos con:
+    #   SELECT emisor_id, codigo_interno, count(*) FROM producto
+    #   GROUP BY 1, 2 HAVING count(*) > 1;
+    "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_producto_emisor_codigo "
+    "ON producto (emisor_id, codigo_interno)",
+    "DROP INDEX CONCURRENTLY IF EXISTS idx_producto_emisor_codigo",
+    # --- producto: listado (WHERE emisor_id, activo ORDER BY favorito, uso) ---
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_producto_emisor_activo_uso "
+    "ON producto (emisor_id, activo, es_favorito DESC, veces_usado DESC)",
+    "DROP INDEX CONCURRENTLY IF EXISTS idx_producto_favorito",
+    # --- producto: categorías del emisor (listar_categorias) ---
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_producto_emisor_categoria "
+    "ON producto (emisor_id, categoria) WHERE categoria IS NOT NULL AND categoria <> ''",
+    # --- producto: búsqueda ILIKE '%q%' (buscar_productos, listar_productos) ---
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_producto_codigo_trgm "
+    "ON producto USING gin (codigo_interno gin_trgm_ops)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_producto_codigo_barras_trgm "
+    "ON producto USING gin (codigo_barras gin_trgm_ops)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_producto_descripcion_trgm "
+    "ON producto USING gin (descripcion gin_trgm_ops)",
+]
+
+
+def main():
+    send_mode = '--send' in sys.argv
+    print("=" * 72)
+    print("ÍNDICES DE RENDIMIENTO")
+    print("MODO:", "🚨 APLICAR DDL" if send_mode else "🧪 DRY-RUN (sin escribir)")
+    print("=" * 72)
+
+    if not send_mode:
+        for sentencia in SENTENCIAS:
+            print(f"  {sentencia};")
+        print("\n🧪 DRY-RUN: no se escribió. Para aplicar:  python -m src.scripts.indices_rendimiento --send")
+        return
+
+    # CREATE INDEX CONCURRENTLY no puede correr dentro de una transacción.
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        # Sin el statement_timeout de la app (DB_STATEMENT_TIMEOUT_MS): en tablas
+        # grandes el índice tarda más y cancelarlo lo deja INVALID.
+        conn.execute(text("SET statement_timeout = 0"))
+        for sentencia in SENTENCIAS:
+            try:
+                conn.execute(text(sentencia))
+            except Exception as e:
+                print(f"🛑 Falló: {sentencia}\n   {e}")
+                sys.exit(1)
+            print(f"✅ {sentencia}")
+
+
+if __name__ == '__main__':
+    main()
@@ -27,13 +27,12 @@ import sys
 from datetime import datetime
 from uuid import uuid4
 
-from sqlalchemy import func
-
 from src.api.dependencies import SessionLocal
 from src.models.models import Comprobante, Emisor, RespuestaSunat, LineaDetalle
 from src.services.xml_generator import build_invoice_xml
 from src.services.firma_digital import firmar_xml
 from src.services.sunat_client import enviar_comprobante
+from src.services.correlativo_service import siguiente_numero
 
 # Reutilizar el flujo corregido y probado del script de prueba
 from src.scripts.nc_prueba_bingazo import (
@@ -125,19 +124,10 @@ def _validar_boleta(db, numero, dni_esperado):
 def _construir_nc(db, boleta, emisor, extra=0):
     """Construye (sin persistir) la NC BC40 y sus líneas replicando la boleta. Devuelve (nc, lineas).
 
-    `extra` desplaza el correlativo para simular numeración secuencial en dry-run (donde nada
-    se commitea y max(numero) no avanza). En --send siempre es 0: el max real avanza por commit.
+    `extra` desplaza el correlativo para simular numeración secuencial en dry-run (donde cada
+    NC se revierte y el correlativo no avanza). En --send siempre es 0: avanza por commit.
     """
-    max_numero = (
-        db.query(func.max(Comprobante.numero))
-        .filter(
-            Comprobante.emisor_id == emisor.id,
-            Comprobante.serie == NC_SERIE,
-            Comprobante.tipo_documento == NC_TIPO,
-        )
-        .scalar()
-    )
-    siguiente = ((max_numero + 1) if max_numero else 1) + extra
+    siguiente = siguiente_numero(db, emisor.id, NC_SERIE, NC_TIPO) + extra
     numero_formato = f"{NC_SERIE}-{str(siguiente).zfill(8)}"
     nc = Comprobante(
         id=str(uuid4()),
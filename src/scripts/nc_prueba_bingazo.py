@@ -36,6 +36,7 @@ from src.models.models import (
 from src.services.xml_generator import build_invoice_xml
 from src.services.firma_digital import firmar_xml
 from src.services.sunat_client import enviar_comprobante
+from src.services.correlativo_service import siguiente_numero as siguiente_numero_correlativo
 
 # =====================================================================
 # PARÁMETROS FIJOS DEL CASO (no cambiar sin autorización de Duilio)
@@ -221,17 +222,7 @@ def main():
         print(f"[3] OK: emisor {emisor.ruc} produccion={getattr(emisor, 'produccion', False)} cert OK.")
 
         # 4) Construir NC BC40 replicando la boleta
-        from sqlalchemy import func
-        max_numero = (
-            db.query(func.max(Comprobante.numero))
-            .filter(
-                Comprobante.emisor_id == emisor.id,
-                Comprobante.serie == NC_SERIE,
-                Comprobante.tipo_documento == NC_TIPO,
-            )
-            .scalar()
-        )
-        siguiente_numero = (max_numero + 1) if max_numero else 1
+        siguiente_numero = siguiente_numero_correlativo(db, emisor.id, NC_SERIE, NC_TIPO)
         numero_formato = f"{NC_SERIE}-{str(siguiente_numero).zfill(8)}"
         fecha_peru = datetime.now(PERU_TZ).date()
 
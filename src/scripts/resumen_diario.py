@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+resumen_diario.py — recalcula comprobante_resumen_diario desde la tabla comprobante.
+
+La tabla y sus triggers (trg_comprobante_resumen_diario_*, ver src/models/models.py)
+se crean solos en el create_all del arranque, pero los triggers solo registran cambios
+desde ese momento: en una BD existente hay que poblar el histórico UNA vez. También
+sirve para reconstruir el resumen si alguna vez se desincroniza.
+
+Corre en una sola transacción con LOCK de comprobante en modo SHARE ROW EXCLUSIVE:
+las emisiones esperan unos segundos (no se pierden) y los triggers no pueden correr en
+paralelo con el recálculo. Sin el statement_timeout de la app: el agregado completo
+puede tardar más.
+
+Ejecutar EN RAILWAY:
+  Dry-run (muestra lo que se cargaría, no escribe):  python -m src.scripts.resumen_diario
+  Aplicar:                                           python -m src.scripts.resumen_diario --send
+"""
+
+import sys
+
+from sqlalchemy import text
+
+from src.api.dependencies import engine
+
+AGREGADO = """
+    SELECT emisor_id, fecha_emision, coalesce(estado, ''), tipo_documento,
+           count(*), coalesce(sum(monto_total), 0)
+      FROM comprobante
+     GROUP BY 1, 2, 3, 4
+"""
+
+
+def main():
+    send_mode = '--send' in sys.argv
+    print("=" * 72)
+    print("RESUMEN DIARIO DE COMPROBANTES")
+    print("MODO:", "🚨 RECALCULAR" if send_mode else "🧪 DRY-RUN (sin escribir)")
+    print("=" * 72)
+
+    with engine.begin() as conn:
+        conn.execute(text("SET LOCAL statement_timeout = 0"))
+        if not send_mode:
+            filas = conn.execute(text(f"SELECT count(*) FROM ({AGREGADO}) t")).scalar()
+            print(f"  Filas de resumen a cargar: {filas}")
+            print("\n🧪 DRY-RUN: no se escribió. Para aplicar:  python -m src.scripts.resumen_diario --send")
+            return
+
+        conn.execute(text("LOCK TABLE comprobante IN SHARE ROW EXCLUSIVE MODE"))
+        conn.execute(text("DELETE FROM comprobante_resumen_diario"))
+        resultado = conn.execute(text(
+            "INSERT INTO comprobante_resumen_diario "
+            "(emisor_id, fecha, estado, tipo_documento, cantidad, monto_total)" + AGREGADO
+        ))
+        print(f"✅ {resultado.rowcount} filas de resumen cargadas")
+
+
+if __name__ == '__main__':
+    main()
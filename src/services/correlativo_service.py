@@ -0,0 +1,58 @@
+"""
+Numeración de comprobantes por (emisor, serie, tipo) sobre la tabla `correlativo`.
+
+Todas las rutas que emiten (routes.emitir_comprobante, routes.emitir_nota_credito,
+API v1 y los scripts de NC) toman el número de aquí. El UPDATE ... RETURNING
+bloquea la fila del correlativo hasta el commit: las emisiones concurrentes de una
+misma serie esperan su turno y reciben números distintos; si la transacción se
+revierte, el número vuelve a quedar libre. El respaldo final es el índice único
+uq_comprobante_emisor_tipo_serie_numero.
+
+La tabla se siembra una vez con src/scripts/correlativos.py. Una serie que aún no
+tiene fila (serie nueva) se crea partiendo de max(numero) de comprobante: esa
+consulta corre solo la primera vez, no en cada emisión.
+"""
+from sqlalchemy import func, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from src.models.models import Comprobante, Correlativo
+
+
+def siguiente_numero(db, emisor_id: str, serie: str, tipo_documento: str) -> int:
+    """Reserva y devuelve el siguiente número de la serie (dentro de la transacción de `db`)."""
+    numero = db.execute(
+        update(Correlativo)
+        .where(
+            Correlativo.emisor_id == emisor_id,
+            Correlativo.serie == serie,
+            Correlativo.tipo_documento == tipo_documento,
+        )
+        .values(ultimo_numero=Correlativo.ultimo_numero + 1)
+        .returning(Correlativo.ultimo_numero)
+        .execution_options(synchronize_session=False)
+    ).scalar()
+    if numero is not None:
+        return numero
+
+    # Serie sin fila: crearla desde lo ya emitido. ON CONFLICT por si otra emisión
+    # concurrente la creó primero (entonces solo se incrementa).
+    max_actual = (
+        select(func.coalesce(func.max(Comprobante.numero), 0))
+        .where(
+            Comprobante.emisor_id == emisor_id,
+            Comprobante.serie == serie,
+            Comprobante.tipo_documento == tipo_documento,
+        )
+        .scalar_subquery()
+    )
+    stmt = pg_insert(Correlativo).values(
+        emisor_id=emisor_id,
+        serie=serie,
+        tipo_documento=tipo_documento,
+        ultimo_numero=max_actual + 1,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['emisor_id', 'serie', 'tipo_documento'],
+        set_={"ultimo_numero": Correlativo.ultimo_numero + 1},
+    ).returning(Correlativo.ultimo_numero)
+    return db.execute(stmt).scalar_one()
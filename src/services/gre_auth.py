@@ -11,6 +11,7 @@ con Fernet/encryption_key (igual que sol_password).
 
 import time
 import logging
+from functools import lru_cache
 
 import requests
 from cryptography.fernet import Fernet
@@ -33,6 +34,7 @@ _RENEW_MARGIN = 120
 _token_cache: dict[str, dict] = {}
 
 
+@lru_cache(maxsize=1)
 def _fernet() -> Fernet:
     return Fernet(settings.encryption_key.encode())
 
@@ -12,6 +12,8 @@ emisor). El stock vive en producto.stock_actual; el kardex en movimientos_stock.
 - descontar_por_guia: igual con ítems de la GRE, pero solo si la guía NO está
   vinculada a una factura (anti doble descuento).
 - revertir_por_origen: entradas inversas si un documento se anula/rechaza.
+- incrementar_uso: suma 1 a producto.veces_usado de los códigos emitidos
+  (UPDATE atómico; orden del listado/autocomplete).
 
 Idempotencia: descontar_por_* no vuelve a descontar si ya existe un movimiento
 para ese origen (origen_tipo, origen_id).
@@ -19,7 +21,7 @@ para ese origen (origen_tipo, origen_id).
 import logging
 from decimal import Decimal
 
-from sqlalchemy import text
+from sqlalchemy import func, text, update
 
 from src.models.models import (
     Producto, MovimientoStock, Comprobante, GuiaRemision, peru_now,
@@ -211,3 +213,22 @@ def revertir_por_origen(db, origen_tipo, origen_id):
             origen_tipo=origen_tipo, origen_id=origen_id, glosa=glosa,
         ))
     return reversiones
+
+
+def incrementar_uso(db, emisor_id, codigos):
+    """Suma 1 a veces_usado de cada producto del emisor cuyo codigo_interno esté
+    en `codigos`. Un solo UPDATE atómico (veces_usado = veces_usado + 1), sin
+    leer la fila antes: emisiones concurrentes no pierden incrementos y el lock
+    de fila dura solo lo que tarda el UPDATE. Devuelve las filas afectadas."""
+    codigos = sorted({c for c in codigos if c})
+    if not codigos:
+        return 0
+    resultado = db.execute(
+        update(Producto)
+        .where(Producto.emisor_id == emisor_id,
+               Producto.codigo_interno.in_(codigos))
+        .values(veces_usado=func.coalesce(Producto.veces_usado, 0) + 1)
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+    return resultado.rowcount
@@ -0,0 +1,62 @@
+"""
+estimar_filas / contar_estimado contra PostgreSQL real (DATABASE_URL), con las dos
+sesiones que usan los listados: get_db_ro (AUTOCOMMIT) y get_db (transaccional).
+Sin PostgreSQL accesible los tests se saltan.
+"""
+import pytest
+from sqlalchemy import func, literal_column, text
+from sqlalchemy.exc import OperationalError
+
+from src.api.dependencies import get_db, get_db_ro
+from src.api.paginacion import contar_estimado, estimar_filas
+
+
+def _sesion(dependencia):
+    gen = dependencia()
+    db = next(gen)
+    try:
+        db.execute(text("SELECT 1"))
+    except OperationalError:
+        gen.close()
+        pytest.skip("PostgreSQL no disponible (DATABASE_URL)")
+    return gen, db
+
+
+@pytest.fixture
+def db_ro():
+    gen, db = _sesion(get_db_ro)
+    yield db
+    gen.close()
+
+
+@pytest.fixture
+def db_rw():
+    gen, db = _sesion(get_db)
+    yield db
+    gen.close()
+
+
+def _serie(db, filas):
+    # generate_series: el planner estima exactamente `filas`, sin tablas del esquema
+    return db.query(literal_column("n")).select_from(func.generate_series(1, filas).alias("n"))
+
+
+def _rota(db):
+    return db.query(literal_column("1")).select_from(text("tabla_que_no_existe"))
+
+
+def test_estimar_filas_en_autocommit(db_ro, caplog):
+    assert estimar_filas(_serie(db_ro, 10000)) == 10000
+    assert "falló" not in caplog.text
+
+
+def test_contar_estimado_en_autocommit_usa_la_estimacion(db_ro):
+    assert contar_estimado(_serie(db_ro, 10000)) == (10000, True)
+    assert contar_estimado(_serie(db_ro, 10)) == (10, False)
+
+
+@pytest.mark.parametrize("fixture", ["db_ro", "db_rw"])
+def test_explain_fallido_no_rompe_la_sesion(fixture, request):
+    db = request.getfixturevalue(fixture)
+    assert estimar_filas(_rota(db)) is None
+    assert db.execute(text("SELECT 1")).scalar() == 1
@@ -0,0 +1,29 @@
+"""
+get_db_ro (listados del dashboard): AUTOCOMMIT y read-only. paginacion.estimar_filas
+depende del AUTOCOMMIT para no abrir un SAVEPOINT (ver tests/test_paginacion.py).
+"""
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from src.api.dependencies import engine_ro, get_db_ro
+from src.core.config import settings
+
+
+def test_engine_ro_es_autocommit():
+    assert engine_ro.get_execution_options()["isolation_level"] == "AUTOCOMMIT"
+
+
+@pytest.mark.skipif(settings.db_null_pool, reason="con PgBouncer la sesión RO no es read-only")
+def test_sesion_ro_rechaza_escrituras():
+    gen = get_db_ro()
+    db = next(gen)
+    try:
+        try:
+            db.execute(text("SELECT 1"))
+        except OperationalError:
+            pytest.skip("PostgreSQL no disponible (DATABASE_URL)")
+        assert db.connection().get_execution_options()["isolation_level"] == "AUTOCOMMIT"
+        assert db.execute(text("SHOW transaction_read_only")).scalar() == "on"
+    finally:
+        gen.close()